@@ -0,0 +1,244 @@
+# ASGI entry point: uvicorn asgi:app
+# The I/O-bound patient endpoints (OTP login, text downloads and the message
+# stream) are served by async handlers so a slow SMS gateway, client or idle
+# stream does not tie up a thread; everything else, including the Dash admin
+# dashboard, runs through the WSGI app on a thread pool.
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote, parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import main
+
+# asgiref runs WSGI apps on a single thread-sensitive executor by default, so one
+# slow Flask or Dash request would hold up all the others. Moving them onto a pool
+# means re-wrapping asgiref's run_wsgi_app, which is internal: asgiref is pinned in
+# requirements.txt to the release this was tested against.
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+# Async streams only cost a socket and a small coroutine each
+ASGI_SSE_MAX_STREAMS = int(os.environ.get('ASGI_SSE_MAX_STREAMS', 5000))
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='wsgi')
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    async def run_wsgi_app(self, body):
+        run = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False,
+                            executor=wsgi_executor)
+        await run(self, body)
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+flask_app = main.server
+wsgi_app = ThreadPoolWsgiToAsgi(flask_app)
+session_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+session_cookie = flask_app.config['SESSION_COOKIE_NAME']
+
+# =====================
+# Session cookie (shared with the Flask app)
+# =====================
+def read_session(scope):
+    for name, value in scope.get('headers', []):
+        if name != b'cookie':
+            continue
+        for part in value.decode('latin-1').split(';'):
+            key, _, val = part.strip().partition('=')
+            if key == session_cookie:
+                try:
+                    return dict(session_serializer.loads(val, max_age=int(
+                        flask_app.permanent_session_lifetime.total_seconds())))
+                except Exception:
+                    return {}
+    return {}
+
+def session_cookie_header(data):
+    cookie = f"{session_cookie}={session_serializer.dumps(data)}; HttpOnly; Path=/"
+    if flask_app.config.get('SESSION_COOKIE_SECURE'):
+        cookie += '; Secure'
+    samesite = flask_app.config.get('SESSION_COOKIE_SAMESITE')
+    if samesite:
+        cookie += f'; SameSite={samesite}'
+    return (b'set-cookie', cookie.encode('latin-1'))
+
+# =====================
+# Responses
+# =====================
+async def send_response(send, body, content_type, headers=(), status=200):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1')), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, payload, headers=()):
+    await send_response(send, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+async def send_text_file(send, content, filename):
+    disposition = f"attachment; filename={quote(filename)}"
+    await send_response(send, content.encode('utf-8'), 'text/plain; charset=utf-8',
+                        [(b'content-disposition', disposition.encode('latin-1'))])
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        return {}
+
+NOT_AUTHENTICATED = {'success': False, 'message': 'Not authenticated'}
+
+# =====================
+# Async handlers
+# =====================
+async def get_otp(scope, receive, send):
+    data = await read_json(receive)
+    payload, otp = main.issue_otp(data.get('mobile'))
+    if otp:
+        await main.otp_sender.send(data.get('mobile'), otp)
+    await send_json(send, payload)
+
+async def verify_otp(scope, receive, send):
+    data = await read_json(receive)
+    payload, session_values = main.check_otp(data.get('mobile'), data.get('otp'),
+                                             data.get('remember_me', False))
+    if not session_values:
+        return await send_json(send, payload)
+    user_session = read_session(scope)
+    user_session.update(session_values)
+    await send_json(send, payload, [session_cookie_header(user_session)])
+
+async def download_record(scope, receive, send, record_type, record_id):
+    user_session = read_session(scope)
+    if 'user' not in user_session:
+        return await send_json(send, NOT_AUTHENTICATED)
+    await send_text_file(send, main.record_content(record_type, user_session.get('name', 'Unknown')),
+                         f"{record_type}_record_{record_id}.txt")
+
+async def download_all_records(scope, receive, send):
+    user_session = read_session(scope)
+    if 'user' not in user_session:
+        return await send_json(send, NOT_AUTHENTICATED)
+    await send_text_file(send, main.all_records_content(user_session.get('name', 'Unknown')),
+                         f"complete_medical_records_{datetime.now().strftime('%Y%m%d')}.txt")
+
+async def download_receipt(scope, receive, send, receipt_id):
+    user_session = read_session(scope)
+    if 'user' not in user_session:
+        return await send_json(send, NOT_AUTHENTICATED)
+    payment = next((p for p in main.payment_history if p['id'] == receipt_id), None)
+    if not payment:
+        return await send_json(send, {'success': False, 'message': 'Receipt not found'})
+    await send_text_file(send, main.receipt_content(payment, user_session.get('name', 'Unknown')),
+                         f"receipt_{receipt_id}.txt")
+
+async def view_statements(scope, receive, send):
+    user_session = read_session(scope)
+    if 'user' not in user_session:
+        return await send_json(send, NOT_AUTHENTICATED)
+    await send_text_file(send, main.statements_content(user_session.get('name', 'Unknown')),
+                         f"billing_statements_{datetime.now().strftime('%Y%m')}.txt")
+
+async def message_stream(scope, receive, send):
+    user_session = read_session(scope)
+    if 'user' not in user_session:
+        return await send_json(send, NOT_AUTHENTICATED)
+    patient = user_session['user']
+    headers = dict(scope.get('headers', []))
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    resume = headers.get(b'last-event-id', b'').decode('latin-1') or query.get('after', [None])[0]
+    last_id = main.stream_start_id(patient, resume)
+
+    if not main.acquire_stream_slot(ASGI_SSE_MAX_STREAMS):
+        return await send_response(send, b'Too many open message streams', 'text/plain', [(b'retry-after', b'5')],
+                                   status=503)
+
+    # add_message runs on other threads; it only sets this event on our loop
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    def listener():
+        loop.call_soon_threadsafe(changed.set)
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        changed.set()
+
+    main.subscribe_messages(patient, listener)
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        while not watcher.done():
+            changed.clear()
+            new_messages = main.messages_after(patient, last_id)
+            if new_messages:
+                last_id = new_messages[-1]['id']
+                body = ''.join(main.sse_message_event(message) for message in new_messages)
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), main.SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+    except OSError:
+        pass
+    finally:
+        watcher.cancel()
+        main.unsubscribe_messages(patient, listener)
+        main.release_stream_slot()
+
+# =====================
+# Routing
+# =====================
+def match_route(method, path):
+    parts = path.strip('/').split('/')
+    if method == 'POST' and path == '/get-otp':
+        return get_otp, ()
+    if method == 'POST' and path == '/verify-otp':
+        return verify_otp, ()
+    if method != 'GET':
+        return None, ()
+    if len(parts) == 3 and parts[0] == 'download-record' and parts[2].isdigit():
+        return download_record, (parts[1], int(parts[2]))
+    if len(parts) == 2 and parts[0] == 'download-receipt' and parts[1]:
+        return download_receipt, (parts[1],)
+    if path == '/download-all-records':
+        return download_all_records, ()
+    if path == '/view-statements':
+        return view_statements, ()
+    if path == '/api/messages/stream':
+        return message_stream, ()
+    return None, ()
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(scope, receive, send)
+    if scope['type'] == 'http':
+        handler, args = match_route(scope['method'], scope['path'])
+        if handler:
+            return await handler(scope, receive, send, *args)
+    await wsgi_app(scope, receive, send)
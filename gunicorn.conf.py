@@ -0,0 +1,29 @@
+# Picked up automatically by `gunicorn main:server` when run from this directory.
+# /api/messages/stream holds its request thread for as long as the page is open,
+# so the default sync worker (one request at a time, killed after `timeout`
+# seconds) cannot serve it. gthread workers heartbeat from their main loop, so
+# long-lived streams are fine as long as threads are left for ordinary requests.
+# For many open streams prefer `uvicorn asgi:app`, which serves them without a thread.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+timeout = 30
+
+# Threads per worker kept free of message streams
+SSE_RESERVED_THREADS = int(os.environ.get('SSE_RESERVED_THREADS', 8))
+
+
+def post_worker_init(worker):
+    # Size the per-worker stream cap from the worker class actually in use; with
+    # no spare threads streams are refused and the page falls back to polling
+    if 'SSE_MAX_STREAMS' in os.environ:
+        return
+    import main
+    worker_class_name = worker.cfg.worker_class_str
+    if worker_class_name == 'sync':
+        main.SSE_MAX_STREAMS = 0
+    elif worker_class_name == 'gthread':
+        main.SSE_MAX_STREAMS = max(worker.cfg.threads - SSE_RESERVED_THREADS, 0)
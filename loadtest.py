@@ -0,0 +1,461 @@
+"""Load-test harness for the clinic portal.
+
+Replays mixed patient and admin traffic against the app and reports throughput
+and p50/p95/p99 latency per endpoint. Runs in-process through the Flask test
+client by default, or against a locally running server with --url:
+
+    python loadtest.py --concurrency 8 --duration 30
+    python loadtest.py --url http://127.0.0.1:8080 --concurrency 32 --streams 100
+
+Only the standard library and the app itself are used.
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+PATIENT_MOBILE = '1234567890'
+ADMIN_EMAIL, ADMIN_PASSWORD = 'admin@hospital.com', 'admin123'
+PATIENT_PAGES = ['/dashboard', '/appointments', '/records', '/bill-pay', '/messages']
+RECEIPT_IDS = ['nov-2024', 'oct-2024', 'sep-2024', 'aug-2024', 'jul-2024']
+# Doctors of the demo patient's upcoming appointments 1-3
+DOCTORS = ['Dr. Sarah Johnson', 'Dr. Michael Chen', 'Dr. Emily Davis']
+FILTER_IDS = ['clinic-filter', 'age-filter', 'gender-filter', 'barrier-filter', 'mobile-filter']
+DRILLDOWN_SORT_COLUMNS = ['total_engagement', 'portal_satisfaction_1_5', 'logins', 'month']
+
+# =====================
+# CLIENTS
+# =====================
+
+class ClientResponse:
+    def __init__(self, status, body, location=None):
+        self.status = status
+        self.body = body
+        # Path the request was redirected to, if any
+        self.location = location
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, form=None, headers=None):
+        response = self.client.open(path, method=method, json=json_body, data=form, headers=headers)
+        location = response.headers.get('Location') if 300 <= response.status_code < 400 else None
+        if location:
+            location = urllib.parse.urlparse(location).path
+        return ClientResponse(response.status_code, response.get_data(), location)
+
+    def open_stream(self, path):
+        response = self.client.get(path, buffered=False)
+
+        def close():
+            try:
+                response.close()
+            except ValueError:
+                # Still blocked inside the app waiting for the next event; the daemon
+                # thread is abandoned with the process
+                pass
+        return response.status_code, iter(response.response), close
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def _build(self, method, path, json_body=None, form=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+
+    def request(self, method, path, json_body=None, form=None, headers=None):
+        try:
+            with self.opener.open(self._build(method, path, json_body, form, headers), timeout=60) as response:
+                # urllib follows redirects itself; report where it ended up
+                final_path = urllib.parse.urlparse(response.geturl()).path
+                location = final_path if final_path != urllib.parse.urlparse(path).path else None
+                return ClientResponse(response.status, response.read(), location)
+        except urllib.error.HTTPError as e:
+            return ClientResponse(e.code, e.read())
+
+    def open_stream(self, path):
+        try:
+            response = self.opener.open(self._build('GET', path), timeout=120)
+        except urllib.error.HTTPError as e:
+            return e.code, iter(()), e.close
+        chunks = iter(lambda: response.readline(), b'')
+
+        def close():
+            # Shutting the socket down wakes a readline blocked waiting for the next event
+            if response.isclosed():
+                return
+            try:
+                sock = socket.socket(fileno=response.fileno())
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                finally:
+                    sock.detach()
+            except (OSError, ValueError):
+                pass
+            response.close()
+        return response.status, chunks, close
+
+# =====================
+# STATS
+# =====================
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.last_finished = None
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.last_finished = time.time()
+            if not ok:
+                self.errors[endpoint] += 1
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def print_report(stats, elapsed):
+    print(f"\n{'endpoint':<44}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    total = 0
+    for endpoint in sorted(stats.latencies):
+        values = sorted(stats.latencies[endpoint])
+        total += len(values)
+        print(f"{endpoint:<44}{len(values):>8}{stats.errors[endpoint]:>8}{len(values) / elapsed:>9.1f}"
+              f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 95) * 1000:>9.1f}"
+              f"{percentile(values, 99) * 1000:>9.1f}")
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+# =====================
+# SCENARIOS
+# =====================
+
+LOGIN_ATTEMPTS = 10
+
+def response_ok(response, login_redirect_ok=False):
+    # The app reports most failures as 200 + {"success": false}, and pages bounce
+    # signed-out users to the login page, so the status code alone is not enough
+    if response.status >= 400 or (response.location == '/' and not login_redirect_ok):
+        return False
+    if response.body[:1] == b'{':
+        body = response.json()
+        if isinstance(body, dict) and body.get('success') is False:
+            return False
+    return True
+
+def timed(stats, client, endpoint, method, path, login_redirect_ok=False, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = client.request(method, path, **kwargs)
+        ok = response_ok(response, login_redirect_ok)
+    except Exception:
+        response, ok = None, False
+    stats.record(endpoint, time.perf_counter() - started, ok)
+    return response
+
+def login_patient(client, stats):
+    # Every virtual patient shares the one demo number, so a concurrent login can
+    # replace our OTP before it is verified; retry, and give up on the session if
+    # it never sticks rather than timing signed-out requests
+    started = time.perf_counter()
+    for _ in range(LOGIN_ATTEMPTS):
+        response = timed(stats, client, 'POST /get-otp', 'POST', '/get-otp', json_body={'mobile': PATIENT_MOBILE})
+        otp = (response.json() or {}).get('otp') if response else None
+        response = timed(stats, client, 'POST /verify-otp', 'POST', '/verify-otp',
+                         json_body={'mobile': PATIENT_MOBILE, 'otp': otp, 'remember_me': False})
+        if response is not None and response_ok(response):
+            stats.record('patient login', time.perf_counter() - started, True)
+            return True
+    stats.record('patient login', time.perf_counter() - started, False)
+    return False
+
+booking_ids = itertools.count(10000)
+
+def book_appointment(app, rng):
+    # The portal has no booking endpoint, so in-process runs put a booking for a free
+    # slot straight into the app's schedule for the session to cancel; the demo
+    # appointments that reschedule uses are left alone
+    doctor = rng.choice(DOCTORS)
+    day = datetime.now() + timedelta(days=rng.randint(1, 60))
+    with app.schedule_lock:
+        slots = app.free_slots(doctor, day, day + timedelta(days=7))
+        if not slots:
+            return None
+        start, end = rng.choice(slots)
+        appointment_id = next(booking_ids)
+        app._insert_booking(app._calendar(doctor), start, end, appointment_id)
+        app.appointments_data['upcoming'].append({
+            'id': appointment_id, 'doctor': doctor, 'specialty': app.doctor_directory()[doctor],
+            'date': start.strftime('%b %d, %Y - %I:%M %p'), 'datetime': start
+        })
+    return appointment_id
+
+def forget_appointment(app, appointment_id):
+    # Cancelling moves the booking to the past list; drop it so pages don't grow over the run
+    with app.schedule_lock:
+        app.appointments_data['past'] = [a for a in app.appointments_data['past'] if a['id'] != appointment_id]
+
+def patient_session(client, stats, rng, steps, deadline, app=None):
+    if not login_patient(client, stats):
+        return
+
+    for _ in range(steps):
+        if time.time() >= deadline:
+            break
+        action = rng.random()
+        if action < 0.4:
+            page = rng.choice(PATIENT_PAGES)
+            timed(stats, client, f'GET {page}', 'GET', page)
+        elif action < 0.55:
+            timed(stats, client, 'GET /download-receipt/<id>', 'GET', f'/download-receipt/{rng.choice(RECEIPT_IDS)}')
+        elif action < 0.65:
+            record_type = rng.choice(['visit', 'lab', 'imaging'])
+            timed(stats, client, 'GET /download-record/<type>/<id>', 'GET',
+                  f'/download-record/{record_type}/{rng.randint(1, 20)}')
+        elif action < 0.75:
+            start = (datetime.now() + timedelta(days=rng.randint(1, 30))).strftime('%Y-%m-%d')
+            query = urllib.parse.urlencode({'doctor': rng.choice(DOCTORS), 'start': start})
+            timed(stats, client, 'GET /availability', 'GET', f'/availability?{query}')
+        elif action < 0.85:
+            # Like the reschedule dialog: look up the doctor's free slots, then move into one
+            appointment_id = rng.randint(1, len(DOCTORS))
+            start = (datetime.now() + timedelta(days=rng.randint(1, 30))).strftime('%Y-%m-%d')
+            query = urllib.parse.urlencode({'doctor': DOCTORS[appointment_id - 1], 'start': start})
+            response = timed(stats, client, 'GET /availability', 'GET', f'/availability?{query}')
+            slots = ((response.json() or {}).get('slots') if response else None) or []
+            if slots:
+                timed(stats, client, 'POST /reschedule-appointment', 'POST', '/reschedule-appointment',
+                      json_body={'appointment_id': appointment_id, 'new_date': rng.choice(slots)['start']})
+        elif action < 0.9 and app is not None:
+            appointment_id = book_appointment(app, rng)
+            if appointment_id is not None:
+                timed(stats, client, 'POST /cancel-appointment', 'POST', '/cancel-appointment',
+                      json_body={'appointment_id': appointment_id})
+                forget_appointment(app, appointment_id)
+        else:
+            timed(stats, client, 'GET /api/messages', 'GET', '/api/messages')
+
+    timed(stats, client, 'GET /logout', 'GET', '/logout', login_redirect_ok=True)
+
+def _find_component(node, component_id):
+    if isinstance(node, dict):
+        if node.get('props', {}).get('id') == component_id:
+            return node['props']
+        return _find_component(node.get('props', {}).get('children'), component_id)
+    if isinstance(node, list):
+        for child in node:
+            found = _find_component(child, component_id)
+            if found is not None:
+                return found
+    return None
+
+def dash_metadata(client):
+    # Callback signatures and filter options are read from the running app
+    dependencies = client.request('GET', '/admin-dashboard/_dash-dependencies').json() or []
+    layout = client.request('GET', '/admin-dashboard/_dash-layout').json()
+    options = {}
+    for component_id in FILTER_IDS:
+        props = _find_component(layout, component_id) or {}
+        options[component_id] = [option['value'] for option in props.get('options', [])]
+    callbacks = {}
+    for dependency in dependencies:
+        if 'main-graph.figure' in dependency['output']:
+            callbacks['render_charts'] = dependency
+        elif 'drilldown-table.data' in dependency['output']:
+            callbacks['update_drilldown'] = dependency
+    return callbacks, options
+
+def dash_update_payload(dependency, values, changed):
+    output = dependency['output']
+    outputs = [{'id': part.rsplit('.', 1)[0], 'property': part.rsplit('.', 1)[1]}
+               for part in re.split(r'\.\.\.', output.strip('.'))]
+    return {
+        'output': output,
+        'outputs': outputs if output.startswith('..') else outputs[0],
+        'inputs': [{**dep, 'value': values.get((dep['id'], dep['property']))} for dep in dependency['inputs']],
+        'state': [{**dep, 'value': values.get((dep['id'], dep['property']))} for dep in dependency['state']],
+        'changedPropIds': [f'{component_id}.{prop}' for component_id, prop in changed]
+    }
+
+def admin_session(client, stats, rng, steps, deadline, metadata):
+    timed(stats, client, 'POST /admin-login', 'POST', '/admin-login',
+          form={'email': ADMIN_EMAIL, 'password': ADMIN_PASSWORD})
+    timed(stats, client, 'GET /admin-dashboard', 'GET', '/admin-dashboard')
+    callbacks, options = metadata
+
+    values = {(component_id, 'value'): [] for component_id in FILTER_IDS}
+    values[('main-chart-index', 'data')] = 0
+    values.update({('drilldown-table', 'page_current'): 0, ('drilldown-table', 'page_size'): 20,
+                   ('drilldown-table', 'sort_by'): [], ('drilldown-table', 'filter_query'): ''})
+
+    for _ in range(steps):
+        if time.time() >= deadline:
+            break
+        if 'update_drilldown' in callbacks and rng.random() < 0.3:
+            changed = [('drilldown-table', 'page_current')]
+            values[('drilldown-table', 'page_current')] = rng.randint(0, 10)
+            if rng.random() < 0.5:
+                values[('drilldown-table', 'sort_by')] = [{'column_id': rng.choice(DRILLDOWN_SORT_COLUMNS),
+                                                           'direction': rng.choice(['asc', 'desc'])}]
+                changed.append(('drilldown-table', 'sort_by'))
+            timed(stats, client, 'POST dash update_drilldown', 'POST', '/admin-dashboard/_dash-update-component',
+                  json_body=dash_update_payload(callbacks['update_drilldown'], values, changed))
+            continue
+
+        component_id = rng.choice(FILTER_IDS + ['main-chart-index'])
+        if component_id == 'main-chart-index':
+            changed = (component_id, 'data')
+            values[changed] = rng.randrange(6)
+        else:
+            changed = (component_id, 'value')
+            choices = options.get(component_id, [])
+            values[changed] = rng.sample(choices, rng.randint(0, min(2, len(choices))))
+        if 'render_charts' in callbacks:
+            timed(stats, client, 'POST dash render_charts', 'POST', '/admin-dashboard/_dash-update-component',
+                  json_body=dash_update_payload(callbacks['render_charts'], values, [changed]))
+
+    timed(stats, client, 'GET /logout', 'GET', '/logout', login_redirect_ok=True)
+
+# =====================
+# RUNNER
+# =====================
+
+def hold_stream(make_client, stats, deadline, counters, closers):
+    client = make_client()
+    if not login_patient(client, stats):
+        stats.record('SSE open /api/messages/stream', 0.0, False)
+        return
+
+    started = time.perf_counter()
+    try:
+        status, chunks, close = client.open_stream('/api/messages/stream')
+    except Exception:
+        stats.record('SSE open /api/messages/stream', time.perf_counter() - started, False)
+        return
+    ok = status == 200
+    closers.append(close)
+    try:
+        # Auth failures come back as a JSON body, so check for the SSE preamble
+        ok = ok and next(chunks, b'').startswith(b'retry:')
+        stats.record('SSE open /api/messages/stream', time.perf_counter() - started, ok)
+        if not ok:
+            return
+        with counters['lock']:
+            counters['open'] += 1
+            counters['peak'] = max(counters['peak'], counters['open'])
+        for _ in chunks:
+            if time.time() >= deadline:
+                break
+    except Exception:
+        pass
+    finally:
+        if ok:
+            with counters['lock']:
+                counters['open'] -= 1
+        close()
+
+def virtual_user(make_client, stats, deadline, seed, args, metadata, app):
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        client = make_client()
+        if rng.random() < args.admin_ratio:
+            admin_session(client, stats, rng, args.steps, deadline, metadata)
+        else:
+            patient_session(client, stats, rng, args.steps, deadline, app)
+        if args.think:
+            time.sleep(rng.uniform(0, args.think))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay mixed patient and admin traffic against the portal.')
+    parser.add_argument('--url', help='Base URL of a running server; omit to run in-process')
+    parser.add_argument('--concurrency', type=int, default=4, help='Virtual users issuing requests')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to run')
+    parser.add_argument('--admin-ratio', type=float, default=0.2, help='Share of sessions that are admins')
+    parser.add_argument('--steps', type=int, default=10, help='Requests per session after login')
+    parser.add_argument('--think', type=float, default=0, help='Max random pause between sessions (seconds)')
+    parser.add_argument('--streams', type=int, default=0, help='Concurrent SSE message streams to hold open')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.url:
+        # Cancels need a booking to cancel, which only an in-process run can create
+        app = None
+
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        import main as app
+
+        def make_client():
+            return InProcessClient(app.server)
+
+    admin_client = make_client()
+    admin_client.request('POST', '/admin-login', form={'email': ADMIN_EMAIL, 'password': ADMIN_PASSWORD})
+    metadata = dash_metadata(admin_client)
+
+    stats = Stats()
+    deadline = time.time() + args.duration
+    counters = {'lock': threading.Lock(), 'open': 0, 'peak': 0}
+    closers = []
+    streams = [threading.Thread(target=hold_stream, args=(make_client, stats, deadline, counters, closers),
+                                daemon=True)
+               for _ in range(args.streams)]
+    users = [threading.Thread(target=virtual_user,
+                              args=(make_client, stats, deadline, args.seed + i, args, metadata, app), daemon=True)
+             for i in range(args.concurrency)]
+
+    mode = args.url or 'in-process'
+    print(f"Running {args.concurrency} virtual users and {args.streams} SSE streams against {mode} "
+          f"for {args.duration:.0f}s...")
+    started = time.time()
+    for thread in streams + users:
+        thread.start()
+    for thread in users:
+        thread.join(max(0, deadline - time.time()) + 60)
+    # Throughput is over the load window: requests in flight at the deadline still
+    # count, but an idle stream waiting for its next heartbeat is not load
+    elapsed = max(stats.last_finished or deadline, deadline) - started
+    for close in list(closers):
+        close()
+    for thread in streams:
+        thread.join(1)
+
+    print_report(stats, elapsed)
+    if args.streams:
+        print(f"SSE streams: peak {counters['peak']} of {args.streams} held open concurrently")
+
+if __name__ == '__main__':
+    main()
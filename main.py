@@ -1,15 +1,40 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file, Response, stream_with_context
 import dash
-from dash import html, dcc, Input, Output, State, callback_context
+from dash import html, dcc, dash_table, Input, Output, State, callback_context
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.utils
 import warnings
 import random
 import time
 import os
+import sys
 import io
+import asyncio
+import abc
+import math
+import stat
+import queue
+import hashlib
+import threading
+import uuid
+import json
+import base64
+import bisect
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from urllib.parse import urlencode
+from xml.sax.saxutils import escape
+from openpyxl import Workbook
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 from datetime import datetime, timedelta
 
 warnings.filterwarnings('ignore')
@@ -18,6 +43,21 @@ warnings.filterwarnings('ignore')
 server = Flask(__name__)
 server.secret_key = 'hospital-portal-secret-key-2024'
 
+# Dashboard cache and export files hold patient data, so their directories are
+# private to this user; a directory somebody else created first is refused
+def private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or (hasattr(os, 'getuid') and st.st_uid != os.getuid()):
+        raise PermissionError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(st.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+def open_private(path, mode='w', **kwargs):
+    # Like open() for writing, but a new file is created 0600 rather than umask-wide
+    return open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode, **kwargs)
+
 # Sample user data
 users = {
     'admin@hospital.com': {'password': 'admin123', 'role': 'admin', 'name': 'Hospital Admin'},
@@ -27,6 +67,24 @@ users = {
 # Store OTPs temporarily
 otp_storage = {}
 
+# OTP delivery is async and pluggable so an SMS gateway client can be dropped in
+# without blocking the async (ASGI) handlers; OTP_SEND_DELAY simulates gateway latency
+class OtpSender(abc.ABC):
+    @abc.abstractmethod
+    async def send(self, mobile, otp):
+        ...
+
+class ConsoleOtpSender(OtpSender):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    async def send(self, mobile, otp):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        print(f"OTP for {mobile}: {otp}")  # For testing
+
+otp_sender = ConsoleOtpSender(float(os.environ.get('OTP_SEND_DELAY', 0)))
+
 # Sample data for appointments, records, and billing
 appointments_data = {
     'upcoming': [
@@ -89,6 +147,52 @@ except:
         merged_data['telehealth_visits']
     )
 
+# COMPACT_DTYPES=1 stores merged_data in the smallest dtypes that hold it:
+# downcast integer counts, categoricals for the text dimensions (datetime months
+# stay as they are) and bool flags.
+# prefers_mobile_app is additionally held bit-packed in the filter bitset index.
+COMPACT_DTYPES = os.environ.get('COMPACT_DTYPES', '0') == '1'
+CATEGORICAL_COLUMNS = ['patient_id', 'month', 'clinic', 'age_group', 'gender', 'barrier_primary']
+FLAG_COLUMNS = ['prefers_mobile_app', 'consent_marketing_opt_in']
+
+def compact_dtypes(data):
+    data = data.copy()
+    for column in data.columns:
+        series = data[column]
+        if column in FLAG_COLUMNS and series.dropna().isin([0, 1]).all() and not series.isna().any():
+            data[column] = series.astype(bool)
+        elif column in CATEGORICAL_COLUMNS and not pd.api.types.is_datetime64_any_dtype(series):
+            data[column] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            data[column] = pd.to_numeric(series, downcast='unsigned' if series.min() >= 0 else 'integer')
+    return data
+
+def flags_as_int(frame):
+    # Compact mode holds the flags as bool; exports and the table show 0/1 either way
+    flags = [c for c in FLAG_COLUMNS if c in frame.columns and pd.api.types.is_bool_dtype(frame[c])]
+    return frame.astype({c: int for c in flags}) if flags else frame
+
+memory_before = merged_data.memory_usage(deep=True, index=False)
+dtypes_before = merged_data.dtypes
+if COMPACT_DTYPES:
+    merged_data = compact_dtypes(merged_data)
+memory_after = merged_data.memory_usage(deep=True, index=False)
+
+memory_report = [
+    {'column': column,
+     'dtype_before': str(dtypes_before[column]),
+     'dtype_after': str(merged_data[column].dtype),
+     'bytes_before': int(memory_before[column]),
+     'bytes_after': int(memory_after[column]),
+     'bytes_per_row_after': round(memory_after[column] / max(len(merged_data), 1), 2)}
+    for column in merged_data.columns
+]
+memory_report.append({'column': 'TOTAL', 'dtype_before': '', 'dtype_after': '',
+                      'bytes_before': int(memory_before.sum()), 'bytes_after': int(memory_after.sum()),
+                      'bytes_per_row_after': round(memory_after.sum() / max(len(merged_data), 1), 2)})
+print(f"merged_data memory: {memory_before.sum() / 1e6:.2f} MB -> {memory_after.sum() / 1e6:.2f} MB"
+      f"{' (compact dtypes)' if COMPACT_DTYPES else ''}")
+
 # Initialize your Dash app
 dash_app = dash.Dash(
     __name__,
@@ -97,27 +201,75 @@ dash_app = dash.Dash(
     suppress_callback_exceptions=True
 )
 
+# =====================
+# TREND DOWNSAMPLING
+# =====================
+
+# Trend lines are cut down to roughly one point per two pixels of chart width
+# with Largest-Triangle-Three-Buckets, which keeps peaks and troughs that plain
+# striding would drop. Series shorter than the target are drawn as-is.
+TREND_POINTS = {'large': 500, 'small': 100}
+TREND_SERIES = ['logins', 'secure_messages', 'appointments_scheduled']
+
+def lttb(x, y, threshold):
+    # Indices of the points LTTB keeps; x must be numeric and ascending
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[selected] - avg_x) * (y[start:end] - y[selected])
+                      - (x[selected] - x[start:end]) * (avg_y - y[selected]))
+        selected = start + int(area.argmax())
+        keep[i + 1] = selected
+    return keep
+
+def trend_totals(data):
+    return data.groupby('month', observed=True)[TREND_SERIES].sum()
+
+def downsample_trend(totals, size):
+    # {series: (x values, y values)}, each series reduced independently
+    x = totals.index.to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(totals.index):
+        numeric_x = x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    elif pd.api.types.is_numeric_dtype(totals.index):
+        numeric_x = x.astype(float)
+    else:
+        numeric_x = np.arange(len(x), dtype=float)
+    points = {}
+    for column in TREND_SERIES:
+        y = totals[column].to_numpy()
+        keep = lttb(numeric_x, y.astype(float), TREND_POINTS[size])
+        points[column] = (x[keep], y[keep])
+    return points
+
+@lru_cache(maxsize=1024)
+def trend_points(filters, size):
+    return downsample_trend(trend_totals(filter_data(filters)), size)
+
 # =====================
 # YOUR CHART CREATION FUNCTIONS
 # =====================
 
-def create_trend_chart(data, size='large'):
-    monthly = data.groupby('month').agg({
-        'logins': 'sum',
-        'secure_messages': 'sum',
-        'appointments_scheduled': 'sum',
-        'patient_id': 'nunique'
-    }).reset_index()
+def create_trend_chart(data, size='large', filters=None):
+    # With filters the downsampled series comes from the per-filter cache
+    points = trend_points(filters, size) if filters is not None else downsample_trend(trend_totals(data), size)
 
     height = 500 if size == 'large' else 140
     show_legend = size == 'large'
 
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=monthly['month'], y=monthly['logins'],
+    fig.add_trace(go.Scatter(x=points['logins'][0], y=points['logins'][1],
                             name='Logins', line=dict(color='#3498db', width=3)))
-    fig.add_trace(go.Scatter(x=monthly['month'], y=monthly['secure_messages'],
+    fig.add_trace(go.Scatter(x=points['secure_messages'][0], y=points['secure_messages'][1],
                             name='Messages', line=dict(color='#e74c3c', width=3)))
-    fig.add_trace(go.Scatter(x=monthly['month'], y=monthly['appointments_scheduled'],
+    fig.add_trace(go.Scatter(x=points['appointments_scheduled'][0], y=points['appointments_scheduled'][1],
                             name='Appointments', line=dict(color='#27ae60', width=3)))
 
     fig.update_layout(
@@ -144,7 +296,7 @@ def create_trend_chart(data, size='large'):
     return fig
 
 def create_clinic_chart(data, size='large'):
-    clinic_stats = data.groupby('clinic').agg({
+    clinic_stats = data.groupby('clinic', observed=True).agg({
         'total_engagement': 'mean',
         'portal_satisfaction_1_5': 'mean',
         'patient_id': 'nunique'
@@ -203,7 +355,7 @@ def create_feature_chart(data, size='large'):
     return fig
 
 def create_demographic_chart(data, size='large'):
-    demo_stats = data.groupby('age_group').agg({
+    demo_stats = data.groupby('age_group', observed=True).agg({
         'total_engagement': 'mean',
         'portal_satisfaction_1_5': 'mean'
     }).reset_index()
@@ -233,12 +385,13 @@ def create_demographic_chart(data, size='large'):
 
 def create_satisfaction_chart(data, size='large'):
     sat_dist = data['portal_satisfaction_1_5'].value_counts().sort_index()
+    sat_df = pd.DataFrame({'score': sat_dist.index, 'patients': sat_dist.values})
 
     height = 500 if size == 'large' else 140
 
-    fig = px.bar(x=sat_dist.index, y=sat_dist.values,
+    fig = px.bar(sat_df, x='score', y='patients',
                  title='😊 Satisfaction' if size == 'small' else '😊 Satisfaction Score Distribution',
-                 color=sat_dist.values,
+                 color='patients',
                  color_continuous_scale='RdYlGn')
 
     fig.update_layout(
@@ -264,12 +417,14 @@ def create_satisfaction_chart(data, size='large'):
 
 def create_barriers_chart(data, size='large'):
     barrier_counts = data['barrier_primary'].value_counts()
+    barrier_counts = barrier_counts[barrier_counts > 0]
+    barrier_df = pd.DataFrame({'barrier': barrier_counts.index, 'patients': barrier_counts.values})
 
     height = 500 if size == 'large' else 140
 
-    fig = px.bar(x=barrier_counts.values, y=barrier_counts.index, orientation='h',
+    fig = px.bar(barrier_df, x='patients', y='barrier', orientation='h',
                  title='🚧 Barriers' if size == 'small' else '🚧 Primary Barriers to Portal Usage',
-                 color=barrier_counts.values,
+                 color='patients',
                  color_continuous_scale='Reds')
 
     fig.update_layout(
@@ -293,6 +448,520 @@ def create_barriers_chart(data, size='large'):
 
     return fig
 
+# =====================
+# FILTER BITSET INDEX
+# =====================
+
+# Filter dropdown -> merged_data column. Each (column, value) pair is stored as a
+# packed bitset of matching rows; a filter is OR within a dimension and AND
+# across dimensions, so evaluating one is a handful of word-wise ops.
+FILTER_COLUMNS = {
+    'clinic': 'clinic',
+    'age': 'age_group',
+    'gender': 'gender',
+    'barrier': 'barrier_primary',
+    'mobile': 'prefers_mobile_app'
+}
+MISSING_VALUE = '__missing__'
+
+def _pack_bits(mask):
+    packed = np.packbits(np.asarray(mask, dtype=bool), bitorder='little')
+    padding = (-len(packed)) % 8
+    if padding:
+        packed = np.concatenate([packed, np.zeros(padding, dtype=np.uint8)])
+    return packed.view(np.uint64)
+
+def _filter_values(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return series.astype(int)
+    return series.astype(object).where(series.notna(), MISSING_VALUE).astype(str)
+
+def build_filter_index(data):
+    index = {}
+    for name, column in FILTER_COLUMNS.items():
+        codes, uniques = pd.factorize(_filter_values(data[column]))
+        index[name] = {value: _pack_bits(codes == code) for code, value in enumerate(uniques.tolist())}
+    return index
+
+def filter_key(clinic_vals=None, age_vals=None, gender_vals=None, barrier_vals=None, mobile_vals=None):
+    # Canonical, hashable form of the dropdown selections; an empty tuple means "all"
+    selections = [clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals]
+    key = []
+    for name, vals in zip(FILTER_COLUMNS, selections):
+        if vals is None or vals == 'all':
+            vals = []
+        elif not isinstance(vals, (list, tuple)):
+            vals = [vals]
+        if name == 'mobile':
+            vals = [int(v) for v in vals]
+        key.append(tuple(sorted(set(vals))))
+    return tuple(key)
+
+ALL_FILTERS = filter_key()
+
+filter_index = build_filter_index(merged_data)
+all_rows_bits = _pack_bits(np.ones(len(merged_data), dtype=bool))
+
+
+def filter_bitset(filters):
+    bits = all_rows_bits.copy()
+    for name, vals in zip(FILTER_COLUMNS, filters):
+        if not vals:
+            continue
+        dimension = filter_index[name]
+        selected = np.zeros_like(bits)
+        for value in vals:
+            if value in dimension:
+                np.bitwise_or(selected, dimension[value], out=selected)
+        np.bitwise_and(bits, selected, out=bits)
+    return bits
+
+if hasattr(np, 'bitwise_count'):
+    def bitset_count(bits):
+        return int(np.bitwise_count(bits).sum())
+else:
+    def bitset_count(bits):
+        return int(np.unpackbits(bits.view(np.uint8)).sum())
+
+def bitset_mask(bits):
+    return np.unpackbits(bits.view(np.uint8), count=len(merged_data), bitorder='little').astype(bool)
+
+def bitset_rows(bits):
+    return np.flatnonzero(bitset_mask(bits))
+
+def filter_data(filters):
+    if filters == ALL_FILTERS:
+        return merged_data
+    return merged_data.take(bitset_rows(filter_bitset(filters)))
+
+def filter_options(name):
+    values = sorted(filter_index[name], key=lambda v: (v == MISSING_VALUE, v))
+    if name == 'mobile':
+        return [{'label': 'Prefers Mobile App' if v else 'Prefers Web Portal', 'value': v}
+                for v in sorted(values, reverse=True)]
+    return [{'label': 'Not Specified' if v == MISSING_VALUE else v, 'value': v} for v in values]
+
+# =====================
+# SVG THUMBNAILS
+# =====================
+
+# THUMBNAIL_MODE=svg renders the thumb row as cached server-side SVG images
+# instead of five live Plotly graphs
+SVG_THUMBNAILS = os.environ.get('THUMBNAIL_MODE', 'graph') == 'svg'
+
+THUMB_WIDTH, THUMB_HEIGHT = 220, 128
+THUMB_PLOT = dict(left=10, top=24, right=210, bottom=120)
+
+def _svg_document(title, body):
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {THUMB_WIDTH} {THUMB_HEIGHT}" '
+        f'width="100%" height="100%" preserveAspectRatio="xMidYMid meet">'
+        f'<text x="{THUMB_PLOT["left"]}" y="14" font-family="Segoe UI, Roboto, Arial, sans-serif" '
+        f'font-size="10" fill="#2a3f5f">{escape(title)}</text>'
+        f'{body}</svg>'
+    )
+
+def _svg_colors(values, scale):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return []
+    span = values.max() - values.min()
+    norm = (values - values.min()) / span if span > 0 else np.full(len(values), 0.5)
+    return px.colors.sample_colorscale(scale, list(norm))
+
+def _svg_lines(title, series):
+    # series: (x positions, values, color); x positions are numeric and may be uneven
+    p = THUMB_PLOT
+    width, height = p['right'] - p['left'], p['bottom'] - p['top']
+    all_values = np.concatenate([np.asarray(values, dtype=float) for _, values, _ in series]) if series else np.array([])
+    body = ''
+    if len(all_values):
+        low, high = all_values.min(), all_values.max()
+        span = high - low if high > low else 1.0
+        all_x = np.concatenate([np.asarray(x, dtype=float) for x, _, _ in series])
+        x_low, x_high = all_x.min(), all_x.max()
+        x_span = x_high - x_low if x_high > x_low else 1.0
+        for x, values, color in series:
+            values = np.asarray(values, dtype=float)
+            x = (np.asarray(x, dtype=float) - x_low) / x_span * width
+            points = ' '.join(
+                f'{p["left"] + xi:.1f},{p["bottom"] - (v - low) / span * height:.1f}'
+                for xi, v in zip(x, values)
+            )
+            body += f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="2"/>'
+    return _svg_document(title, body)
+
+def _svg_bars(title, values, colors, horizontal=False):
+    p = THUMB_PLOT
+    width, height = p['right'] - p['left'], p['bottom'] - p['top']
+    values = np.asarray(values, dtype=float)
+    body = ''
+    if len(values) and values.max() > 0:
+        slot = (height if horizontal else width) / len(values)
+        for i, (v, color) in enumerate(zip(values, colors)):
+            extent = v / values.max() * (width if horizontal else height)
+            if horizontal:
+                x, y, w, h = p['left'], p['top'] + i * slot + slot * 0.1, extent, slot * 0.8
+            else:
+                x, y, w, h = p['left'] + i * slot + slot * 0.1, p['bottom'] - extent, slot * 0.8, extent
+            body += f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" fill="{color}"/>'
+    return _svg_document(title, body)
+
+def _svg_pie(title, values, colors):
+    p = THUMB_PLOT
+    cx, cy = (p['left'] + p['right']) / 2, (p['top'] + p['bottom']) / 2
+    r = (p['bottom'] - p['top']) / 2
+    values = np.asarray(values, dtype=float)
+    total = values.sum()
+    body = ''
+    if total > 0:
+        angle = -math.pi / 2
+        for v, color in zip(values, colors):
+            if v <= 0:
+                continue
+            if v == total:
+                body += f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{r:.1f}" fill="{color}"/>'
+                break
+            end = angle + 2 * math.pi * v / total
+            x1, y1 = cx + r * math.cos(angle), cy + r * math.sin(angle)
+            x2, y2 = cx + r * math.cos(end), cy + r * math.sin(end)
+            large_arc = 1 if end - angle > math.pi else 0
+            body += (f'<path d="M{cx:.1f},{cy:.1f} L{x1:.1f},{y1:.1f} '
+                     f'A{r:.1f},{r:.1f} 0 {large_arc} 1 {x2:.1f},{y2:.1f} Z" fill="{color}"/>')
+            angle = end
+    return _svg_document(title, body)
+
+def _svg_x(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64)
+    if np.issubdtype(x.dtype, np.number):
+        return x
+    return np.arange(len(x))
+
+def svg_trend_thumb(data, filters=None):
+    points = trend_points(filters, 'small') if filters is not None else downsample_trend(trend_totals(data), 'small')
+    return _svg_lines('📈 Monthly Trends', [
+        (_svg_x(points['logins'][0]), points['logins'][1], '#3498db'),
+        (_svg_x(points['secure_messages'][0]), points['secure_messages'][1], '#e74c3c'),
+        (_svg_x(points['appointments_scheduled'][0]), points['appointments_scheduled'][1], '#27ae60')
+    ])
+
+def svg_clinic_thumb(data):
+    clinic_stats = data.groupby('clinic', observed=True)[['total_engagement', 'portal_satisfaction_1_5']].mean()
+    return _svg_bars('🏥 Clinic Performance', clinic_stats['total_engagement'].values,
+                     _svg_colors(clinic_stats['portal_satisfaction_1_5'].values, 'Viridis'))
+
+def svg_feature_thumb(data):
+    counts = [data[c].sum() for c in ['logins', 'secure_messages', 'appointments_scheduled',
+                                      'prescription_refills', 'telehealth_visits']]
+    return _svg_pie('🎯 Feature Usage', counts, px.colors.qualitative.Set3)
+
+def svg_demographic_thumb(data):
+    demo_stats = data.groupby('age_group', observed=True)[['total_engagement', 'portal_satisfaction_1_5']].mean()
+    return _svg_bars('👥 Demographics', demo_stats['total_engagement'].values,
+                     _svg_colors(demo_stats['portal_satisfaction_1_5'].values, 'Plasma'))
+
+def svg_satisfaction_thumb(data):
+    sat_dist = data['portal_satisfaction_1_5'].value_counts().sort_index()
+    return _svg_bars('😊 Satisfaction', sat_dist.values, _svg_colors(sat_dist.values, 'RdYlGn'))
+
+def svg_barriers_thumb(data):
+    barrier_counts = data['barrier_primary'].value_counts()
+    barrier_counts = barrier_counts[barrier_counts > 0]
+    return _svg_bars('🚧 Barriers', barrier_counts.values, _svg_colors(barrier_counts.values, 'Reds'),
+                     horizontal=True)
+
+# Same order as chart_functions in render_charts
+svg_thumb_functions = [
+    svg_trend_thumb,
+    svg_clinic_thumb,
+    svg_feature_thumb,
+    svg_demographic_thumb,
+    svg_satisfaction_thumb,
+    svg_barriers_thumb
+]
+
+@lru_cache(maxsize=1024)
+def render_thumbnail_svg(filters, chart_idx):
+    if svg_thumb_functions[chart_idx] is svg_trend_thumb:
+        return svg_trend_thumb(None, filters)
+    return svg_thumb_functions[chart_idx](filter_data(filters))
+
+def thumbnail_url(filters, chart_idx):
+    query = urlencode({name: vals for name, vals in zip(FILTER_COLUMNS, filters)}, doseq=True)
+    return f'/admin-dashboard-thumbs/{chart_idx}.svg?{query}'
+
+# =====================
+# PATIENT DRILL-DOWN
+# =====================
+
+DRILLDOWN_COLUMNS = [
+    'patient_id', 'month', 'clinic', 'age_group', 'gender',
+    'logins', 'secure_messages', 'appointments_scheduled', 'prescription_refills', 'telehealth_visits',
+    'total_engagement', 'portal_satisfaction_1_5', 'barrier_primary', 'prefers_mobile_app'
+]
+DRILLDOWN_PAGE_SIZE = 20
+DRILLDOWN_CACHE_SIZE = 8
+# Row positions are stored as int32 (4 B/row) whenever the frame allows it
+POSITION_DTYPE = np.int32 if len(merged_data) < 2 ** 31 else np.int64
+
+def _build_sort_index(column):
+    # Row positions of merged_data in ascending column order (NaN last)
+    order = merged_data[column].reset_index(drop=True).sort_values(kind='stable').index.to_numpy()
+    return order.astype(POSITION_DTYPE)
+
+# Numeric columns are indexed up front; the rest are built on first sort
+sort_indexes = {column: _build_sort_index(column) for column in DRILLDOWN_COLUMNS
+                if pd.api.types.is_numeric_dtype(merged_data[column])}
+
+def sort_index(column):
+    if column not in sort_indexes:
+        sort_indexes[column] = _build_sort_index(column)
+    return sort_indexes[column]
+
+TABLE_FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'],
+                          ['ne ', '!='], ['eq ', '='], ['contains '], ['datestartswith ']]
+
+def split_filter_part(filter_part):
+    for operator_type in TABLE_FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return [None] * 3
+
+def table_filter_mask(filter_query):
+    mask = np.ones(len(merged_data), dtype=bool)
+    for filter_part in filter_query.split(' && '):
+        column, operator, value = split_filter_part(filter_part)
+        if column not in DRILLDOWN_COLUMNS:
+            continue
+        series = merged_data[column]
+        try:
+            if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+                if pd.api.types.is_datetime64_any_dtype(series):
+                    value = pd.Timestamp(str(value))
+                elif not pd.api.types.is_numeric_dtype(series):
+                    series, value = series.astype(str), str(value)
+                matched = getattr(series, operator)(value)
+            elif operator == 'contains':
+                matched = series.astype(str).str.contains(str(value), case=False, regex=False)
+            else:
+                matched = series.astype(str).str.startswith(str(value))
+        except (TypeError, ValueError):
+            continue
+        mask &= matched.fillna(False).to_numpy(dtype=bool)
+    return mask
+
+@lru_cache(maxsize=DRILLDOWN_CACHE_SIZE)
+def drilldown_positions(filters, sort_column, descending, filter_query):
+    # Cached per view so turning pages is just a slice of this array
+    mask = bitset_mask(filter_bitset(filters))
+    if filter_query:
+        mask &= table_filter_mask(filter_query)
+    if sort_column is None:
+        return np.flatnonzero(mask).astype(POSITION_DTYPE)
+    order = sort_index(sort_column)
+    if descending:
+        order = order[::-1]
+    return order[mask[order]]
+
+def _memory_row(name, dtype_before, dtype_after, bytes_before, bytes_after):
+    return {'column': name, 'dtype_before': dtype_before, 'dtype_after': dtype_after,
+            'bytes_before': int(bytes_before), 'bytes_after': int(bytes_after),
+            'bytes_per_row_after': round(bytes_after / max(len(merged_data), 1), 2)}
+
+def memory_report_rows():
+    # merged_data columns plus the per-row structures derived from it. For the
+    # derived ones "before" is the plain layout (one bool mask per filter value,
+    # int64 positions) and "after" is what is actually held.
+    rows = len(merged_data)
+    masks = sum(len(dimension) for dimension in filter_index.values())
+    index_bytes = sum(bits.nbytes for dimension in filter_index.values() for bits in dimension.values())
+    position_size = np.dtype(POSITION_DTYPE).itemsize
+    derived = [
+        _memory_row(f'filter bitset index ({masks} values)', 'bool masks', 'packed uint64',
+                    masks * rows, index_bytes),
+        _memory_row(f'drill-down sort indexes ({len(sort_indexes)} built)', 'int64', str(np.dtype(POSITION_DTYPE)),
+                    len(sort_indexes) * rows * 8, sum(order.nbytes for order in sort_indexes.values())),
+        # Upper bound: every cached view can hold one position per row
+        _memory_row(f'drill-down position cache (max {DRILLDOWN_CACHE_SIZE} views)', 'int64',
+                    str(np.dtype(POSITION_DTYPE)), DRILLDOWN_CACHE_SIZE * rows * 8,
+                    DRILLDOWN_CACHE_SIZE * rows * position_size),
+    ]
+    frame_total = memory_report[-1]
+    total = _memory_row('TOTAL incl. derived', '', '',
+                        frame_total['bytes_before'] + sum(row['bytes_before'] for row in derived),
+                        frame_total['bytes_after'] + sum(row['bytes_after'] for row in derived))
+    return memory_report + derived + [total]
+
+def drilldown_records(positions):
+    page = flags_as_int(merged_data.iloc[positions][DRILLDOWN_COLUMNS])
+    if pd.api.types.is_datetime64_any_dtype(page['month']):
+        page = page.assign(month=page['month'].dt.strftime('%Y-%m'))
+    return page.astype(object).where(page.notna(), None).to_dict('records')
+
+# =====================
+# COHORT COMPARISON
+# =====================
+
+# Both cohorts are stacked into one frame tagged with a cohort label, so every
+# KPI comes out of a single (cohort, patient) group-by instead of two full
+# render_charts passes. Cohorts may overlap; B can also be "everyone not in A".
+COHORT_LABELS = ['A', 'B']
+COHORT_REST = 'rest'
+FEATURE_COLUMNS = ['secure_messages', 'appointments_scheduled', 'prescription_refills', 'telehealth_visits']
+FEATURE_NAMES = ['Messages', 'Appointments', 'Refills', 'Telehealth']
+COHORT_DIMENSIONS = {'clinic': 'Clinic', 'age': 'Age', 'gender': 'Gender', 'barrier': 'Barrier', 'mobile': 'Channel'}
+
+def cohort_options(include_rest=False):
+    options = [{'label': 'Everyone not in cohort A', 'value': COHORT_REST}] if include_rest else []
+    for name, label in COHORT_DIMENSIONS.items():
+        options += [{'label': f"{label}: {option['label']}", 'value': f"{name}:{option['value']}"}
+                    for option in filter_options(name)]
+    return options
+
+def cohort_filters(values):
+    # "clinic:North" style dropdown values -> filter_key; REST is handled by the caller
+    selections = {name: [] for name in FILTER_COLUMNS}
+    for value in values or []:
+        name, _, option = value.partition(':')
+        if name in selections:
+            selections[name].append(option)
+    return filter_key(*selections.values())
+
+@lru_cache(maxsize=128)
+def compare_cohorts(filters_a, filters_b):
+    # filters_b=None means the complement of cohort A
+    bits_a = filter_bitset(filters_a)
+    bits_b = np.bitwise_and(all_rows_bits, ~bits_a) if filters_b is None else filter_bitset(filters_b)
+    rows_a, rows_b = bitset_rows(bits_a), bitset_rows(bits_b)
+
+    columns = ['patient_id', 'logins', 'portal_satisfaction_1_5', 'prefers_mobile_app',
+               'total_engagement'] + FEATURE_COLUMNS
+    stacked = merged_data[columns].take(np.concatenate([rows_a, rows_b]))
+    stacked = stacked.assign(
+        cohort=np.repeat(COHORT_LABELS, [len(rows_a), len(rows_b)]),
+        mobile=stacked['prefers_mobile_app'].astype(float),
+        used_feature=stacked[FEATURE_COLUMNS].sum(axis=1) > 0
+    )
+
+    patients = stacked.groupby(['cohort', 'patient_id'], observed=True).agg(
+        logins=('logins', 'mean'),
+        rows=('logins', 'size'),
+        satisfaction_n=('portal_satisfaction_1_5', 'count'),
+        satisfaction_sum=('portal_satisfaction_1_5', 'sum'),
+        mobile=('mobile', 'sum'),
+        used_feature=('used_feature', 'max'),
+        engagement=('total_engagement', 'sum'),
+        **{column: (column, 'sum') for column in FEATURE_COLUMNS}
+    )
+    # A patient's rows are not independent ratings, so the CI is taken over
+    # per-patient mean satisfaction with n = rated patients
+    patients['satisfaction'] = patients['satisfaction_sum'] / patients['satisfaction_n'].where(
+        patients['satisfaction_n'] > 0)
+    cohorts = patients.groupby(level='cohort').agg(
+        patients=('logins', 'size'),
+        avg_logins=('logins', 'mean'),
+        satisfaction=('satisfaction', 'mean'),
+        satisfaction_std=('satisfaction', 'std'),
+        satisfaction_patients=('satisfaction', 'count'),
+        **{column: (column, 'sum') for column in patients.columns if column not in ('logins', 'satisfaction')}
+    ).reindex(COHORT_LABELS)
+    cohorts = cohorts.fillna({column: 0 for column in cohorts.columns
+                              if column not in ('avg_logins', 'satisfaction', 'satisfaction_std')})
+
+    n = cohorts['satisfaction_patients']
+    cohorts['satisfaction_ci'] = 1.96 * cohorts['satisfaction_std'] / np.sqrt(n.where(n > 1))
+    cohorts['mobile_pct'] = cohorts['mobile'] / cohorts['rows'].where(cohorts['rows'] > 0) * 100
+    cohorts['feature_pct'] = cohorts['used_feature'] / cohorts['patients'].where(cohorts['patients'] > 0) * 100
+    per_patient = cohorts[FEATURE_COLUMNS + ['engagement']].div(cohorts['patients'].where(cohorts['patients'] > 0), axis=0)
+
+    distribution = (stacked.groupby(['cohort', 'portal_satisfaction_1_5'], observed=True).size()
+                    .unstack(fill_value=0).reindex(COHORT_LABELS).fillna(0))
+    distribution = distribution.div(distribution.sum(axis=1).where(lambda s: s > 0), axis=0) * 100
+
+    # Patients in both cohorts (shared rows, or rows split across the two)
+    # correlate the samples, so the delta CI below is only approximate
+    patient_ids = patients.index.get_level_values('patient_id')
+    cohort_ids = patients.index.get_level_values('cohort')
+    shared = len(np.intersect1d(patient_ids[cohort_ids == 'A'], patient_ids[cohort_ids == 'B']))
+
+    return {'cohorts': cohorts, 'per_patient': per_patient, 'distribution': distribution,
+            'rows': [len(rows_a), len(rows_b)], 'shared_patients': shared}
+
+def _format_delta(value, fmt, suffix=''):
+    return '-' if pd.isna(value) else format(value, '+' + fmt) + suffix
+
+def cohort_kpi_rows(comparison):
+    cohorts = comparison['cohorts']
+    a, b = cohorts.loc['A'], cohorts.loc['B']
+    rows = []
+    for metric, column, fmt, suffix in [('Total Patients', 'patients', ',.0f', ''),
+                                        ('Avg Monthly Logins', 'avg_logins', '.1f', ''),
+                                        ('Mobile Preference', 'mobile_pct', '.1f', '%'),
+                                        ('Feature Utilization', 'feature_pct', '.1f', '%')]:
+        rows.append({'metric': metric,
+                     'cohort_a': '-' if pd.isna(a[column]) else f"{a[column]:{fmt}}{suffix}",
+                     'cohort_b': '-' if pd.isna(b[column]) else f"{b[column]:{fmt}}{suffix}",
+                     'delta': _format_delta(b[column] - a[column], fmt, ' pp' if suffix == '%' else '')})
+
+    def with_ci(row):
+        if pd.isna(row['satisfaction']):
+            return '-'
+        if pd.isna(row['satisfaction_ci']):
+            return f"{row['satisfaction']:.2f}/5"
+        return f"{row['satisfaction']:.2f} ± {row['satisfaction_ci']:.2f}"
+
+    delta = b['satisfaction'] - a['satisfaction']
+    delta_ci = 1.96 * math.sqrt((a['satisfaction_ci'] / 1.96) ** 2 + (b['satisfaction_ci'] / 1.96) ** 2)
+    if pd.isna(delta):
+        delta_text = '-'
+    elif pd.isna(delta_ci):
+        delta_text = f"{delta:+.2f}"
+    elif comparison['shared_patients']:
+        delta_text = f"{delta:+.2f} ≈ ±{delta_ci:.2f} (approx.: cohorts overlap)"
+    else:
+        delta_text = f"{delta:+.2f} ± {delta_ci:.2f}"
+    rows.insert(2, {'metric': 'Satisfaction Score (95% CI)', 'cohort_a': with_ci(a), 'cohort_b': with_ci(b),
+                    'delta': delta_text})
+    return rows
+
+def cohort_charts(comparison):
+    colors = {'A': '#3498db', 'B': '#e67e22'}
+    distribution, per_patient = comparison['distribution'], comparison['per_patient']
+
+    satisfaction_fig = go.Figure([
+        go.Bar(name=f"Cohort {label}", x=[str(score) for score in distribution.columns],
+               y=distribution.loc[label].values, marker_color=colors[label])
+        for label in COHORT_LABELS
+    ])
+    satisfaction_fig.update_layout(title='😊 Satisfaction Distribution (% of records)', barmode='group',
+                                   xaxis_title='Satisfaction Score (1-5)', yaxis_title='% of Records')
+
+    feature_fig = go.Figure([
+        go.Bar(name=f"Cohort {label}", x=FEATURE_NAMES + ['Total Engagement'],
+               y=per_patient.loc[label].values, marker_color=colors[label])
+        for label in COHORT_LABELS
+    ])
+    feature_fig.update_layout(title='🎯 Feature Usage per Patient', barmode='group', yaxis_title='Per Patient')
+
+    for fig in (satisfaction_fig, feature_fig):
+        fig.update_layout(template='plotly_white', height=360, margin=dict(l=40, r=20, t=50, b=40),
+                          font=dict(size=12), legend=dict(orientation='h', y=-0.2))
+    return satisfaction_fig, feature_fig
+
 # =====================
 # YOUR DASH LAYOUT
 # =====================
@@ -387,6 +1056,15 @@ dash_app.index_string = '''
         }
         .thumb-graph:hover { transform: translateY(-6px); box-shadow: 0 12px 28px rgba(0,0,0,0.18); }
 
+        .drilldown-card {
+            margin-left: 300px;
+            margin-right: 36px;
+            background: rgba(255,255,255,0.98);
+            border-radius: 12px;
+            padding: 14px;
+            box-shadow: 0 10px 28px rgba(2,6,23,0.2);
+        }
+
         @keyframes fadeZoom {
           0%   { opacity: 0; transform: scale(0.98); }
           100% { opacity: 1; transform: scale(1); }
@@ -398,6 +1076,7 @@ dash_app.index_string = '''
             .kpi-row { margin-left: 20px; flex-wrap:wrap; }
             .filter-card { position: static; width: auto; margin: 10px; }
             .thumb-row { margin-left: 20px; margin-right: 20px; }
+            .drilldown-card { margin-left: 20px; margin-right: 20px; }
         }
     </style>
 </head>
@@ -412,6 +1091,11 @@ dash_app.index_string = '''
 </html>
 '''
 
+def thumb_component(i):
+    if SVG_THUMBNAILS:
+        return html.Img(id=f'thumb-{i}', style={'width': '100%', 'height': '100%'})
+    return dcc.Graph(id=f'thumb-{i}', config={'displayModeBar': False})
+
 dash_app.layout = html.Div([
     html.Div([
         html.H1("Patient Portal Analytics Dashboard", style={'margin': 0, 'color': '#eaf6ff'}),
@@ -424,26 +1108,20 @@ dash_app.layout = html.Div([
     html.Div([
         html.H4("Filters", style={'marginTop': 0, 'color': '#fff'}),
         html.Label("Clinic:", style={'display': 'block', 'marginTop': '8px'}),
-        dcc.Dropdown(
-            id='clinic-filter',
-            options=[{'label': 'All Clinics', 'value': 'all'}] +
-                    [{'label': c, 'value': c} for c in merged_data['clinic'].unique()],
-            value='all', clearable=False
-        ),
+        dcc.Dropdown(id='clinic-filter', options=filter_options('clinic'),
+                     value=[], multi=True, placeholder='All Clinics'),
         html.Label("Age Group:", style={'display': 'block', 'marginTop': '10px'}),
-        dcc.Dropdown(
-            id='age-filter',
-            options=[{'label': 'All Ages', 'value': 'all'}] +
-                    [{'label': a, 'value': a} for a in merged_data['age_group'].unique()],
-            value='all', clearable=False
-        ),
+        dcc.Dropdown(id='age-filter', options=filter_options('age'),
+                     value=[], multi=True, placeholder='All Ages'),
         html.Label("Gender:", style={'display': 'block', 'marginTop': '10px'}),
-        dcc.Dropdown(
-            id='gender-filter',
-            options=[{'label': 'All Genders', 'value': 'all'}] +
-                    [{'label': g, 'value': g} for g in merged_data['gender'].unique()],
-            value='all', clearable=False
-        ),
+        dcc.Dropdown(id='gender-filter', options=filter_options('gender'),
+                     value=[], multi=True, placeholder='All Genders'),
+        html.Label("Primary Barrier:", style={'display': 'block', 'marginTop': '10px'}),
+        dcc.Dropdown(id='barrier-filter', options=filter_options('barrier'),
+                     value=[], multi=True, placeholder='All Barriers'),
+        html.Label("Channel:", style={'display': 'block', 'marginTop': '10px'}),
+        dcc.Dropdown(id='mobile-filter', options=filter_options('mobile'),
+                     value=[], multi=True, placeholder='All Channels'),
     ], className='filter-card'),
 
     html.Div([
@@ -493,21 +1171,196 @@ dash_app.layout = html.Div([
 
     html.Div([
         html.Div([
-            html.Div([dcc.Graph(id='thumb-1', config={'displayModeBar': False})], className='thumb-graph', id='thumb-container-1'),
-            html.Div([dcc.Graph(id='thumb-2', config={'displayModeBar': False})], className='thumb-graph', id='thumb-container-2'),
-            html.Div([dcc.Graph(id='thumb-3', config={'displayModeBar': False})], className='thumb-graph', id='thumb-container-3'),
-            html.Div([dcc.Graph(id='thumb-4', config={'displayModeBar': False})], className='thumb-graph', id='thumb-container-4'),
-            html.Div([dcc.Graph(id='thumb-5', config={'displayModeBar': False})], className='thumb-graph', id='thumb-container-5'),
+            html.Div([thumb_component(i)], className='thumb-graph', id=f'thumb-container-{i}')
+            for i in range(1,6)
         ], className='thumb-row')
     ]),
 
+    html.Div([
+        html.H4("Patient Drill-down", style={'marginTop': 0, 'color': '#0b2545'}),
+        html.Div(id='drilldown-count', style={'fontSize': 12, 'color': '#5b6b84', 'marginBottom': 8}),
+        html.Div([
+            html.Button("Export CSV", id='export-csv', n_clicks=0, style={'marginRight': 8}),
+            html.Button("Export XLSX", id='export-xlsx', n_clicks=0),
+            html.Span(id='export-status', style={'fontSize': 12, 'color': '#0b2545', 'marginLeft': 12}),
+            dcc.Store(id='export-job-id'),
+            dcc.Interval(id='export-poll', interval=1000, disabled=True)
+        ], style={'marginBottom': 8}),
+        dash_table.DataTable(
+            id='drilldown-table',
+            columns=[{'name': c, 'id': c} for c in DRILLDOWN_COLUMNS],
+            page_current=0,
+            page_size=DRILLDOWN_PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='single',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_table={'overflowX': 'auto'},
+            style_cell={'fontSize': 12, 'padding': '4px 8px', 'color': '#0b2545'},
+            style_header={'fontWeight': 700}
+        )
+    ], className='drilldown-card'),
+
+    html.Div([
+        html.H4("Cohort Comparison", style={'marginTop': 0, 'color': '#0b2545'}),
+        html.Div([
+            html.Div([
+                html.Label("Cohort A:", style={'fontWeight': 600, 'fontSize': 13}),
+                dcc.Dropdown(id='cohort-a', options=cohort_options(), value=[], multi=True,
+                             placeholder='All Patients')
+            ], style={'flex': 1}),
+            html.Div([
+                html.Label("Cohort B:", style={'fontWeight': 600, 'fontSize': 13}),
+                dcc.Dropdown(id='cohort-b', options=cohort_options(include_rest=True), value=[COHORT_REST],
+                             multi=True, placeholder='All Patients')
+            ], style={'flex': 1})
+        ], style={'display': 'flex', 'gap': 16, 'marginBottom': 8}),
+        html.Div(id='cohort-summary', style={'fontSize': 12, 'color': '#5b6b84', 'marginBottom': 8}),
+        dash_table.DataTable(
+            id='cohort-kpis',
+            columns=[{'name': 'Metric', 'id': 'metric'}, {'name': 'Cohort A', 'id': 'cohort_a'},
+                     {'name': 'Cohort B', 'id': 'cohort_b'}, {'name': 'Delta (B - A)', 'id': 'delta'}],
+            style_table={'overflowX': 'auto'},
+            style_cell={'fontSize': 12, 'padding': '4px 8px', 'color': '#0b2545'},
+            style_header={'fontWeight': 700}
+        ),
+        html.Div([
+            dcc.Graph(id='cohort-satisfaction', config={'displayModeBar': False}, style={'flex': 1}),
+            dcc.Graph(id='cohort-features', config={'displayModeBar': False}, style={'flex': 1})
+        ], style={'display': 'flex', 'gap': 16, 'marginTop': 8})
+    ], className='drilldown-card', style={'marginTop': 16}),
+
+    html.Details([
+        html.Summary("Memory Footprint", style={'fontWeight': 700, 'cursor': 'pointer'}),
+        html.Div("merged_data bytes per column before and after the compact-dtype load"
+                 f" ({'enabled' if COMPACT_DTYPES else 'disabled; set COMPACT_DTYPES=1'}),"
+                 " then the per-row indexes and caches built on top of it",
+                 style={'fontSize': 12, 'color': '#5b6b84', 'margin': '6px 0'}),
+        dash_table.DataTable(
+            id='memory-report',
+            columns=[{'name': c, 'id': c} for c in memory_report[0]],
+            data=memory_report_rows(),
+            style_table={'overflowX': 'auto'},
+            style_cell={'fontSize': 12, 'padding': '4px 8px', 'color': '#0b2545'},
+            style_header={'fontWeight': 700}
+        )
+    ], id='memory-details', className='drilldown-card', style={'marginTop': 16, 'color': '#0b2545'}),
+
     html.Div([
         html.Hr(style={'borderColor': 'rgba(255,255,255,0.06)'}),
-        html.P("🔒 HIPAA Compliance: De-identified aggregate data only. Access restricted to authorized personnel.",
+        html.P("🔒 HIPAA Compliance: De-identified data only; the patient drill-down is row-level. Access restricted to signed-in administrators.",
                style={'color': 'rgba(234,246,255,0.75)', 'textAlign': 'center', 'fontSize': 12, 'paddingBottom': 30})
     ], style={'marginLeft': 260, 'marginRight': 36})
 ])
 
+# =====================
+# CALLBACK SINGLE-FLIGHT
+# =====================
+
+# Concurrent callbacks with the same key share one computation. Each dashboard
+# session also holds the generation of its latest request per callback; a newer
+# request from the same session makes older ones stale, and a computation is
+# abandoned at its next checkpoint once every request waiting on it is stale.
+# Generations come from one process-wide counter, so an entry can be dropped as
+# soon as its request finishes without an older request ever becoming current again.
+class RenderAbandoned(Exception):
+    pass
+
+inflight_renders = {}
+inflight_lock = threading.Lock()
+render_generations = {}
+render_generation_counter = itertools.count(1)
+
+def dashboard_session_id():
+    if 'dashboard_session' not in session:
+        session['dashboard_session'] = uuid.uuid4().hex
+    return session['dashboard_session']
+
+def next_render_token(callback_name):
+    slot = (dashboard_session_id(), callback_name)
+    with inflight_lock:
+        render_generations[slot] = next(render_generation_counter)
+        return slot, render_generations[slot]
+
+def render_token_stale(token):
+    slot, generation = token
+    with inflight_lock:
+        return render_generations.get(slot) != generation
+
+def release_render_token(token):
+    # Called when a request finishes; only the session's latest request clears the slot
+    slot, generation = token
+    with inflight_lock:
+        if render_generations.get(slot) == generation:
+            del render_generations[slot]
+
+# A token of None marks a background caller (the cache warm-up). Its flights are
+# never abandoned, and while nobody live is waiting on them they pause at each
+# checkpoint until no live render is computing. A live request waiting on another
+# flight counts as a live render too, and a paused flight re-checks its waiters
+# every BACKGROUND_YIELD_POLL seconds so it resumes as soon as a live one joins.
+BACKGROUND_YIELD_POLL = 0.05
+live_renders = 0
+live_renders_idle = threading.Event()
+live_renders_idle.set()
+
+def _track_live_render(delta):
+    global live_renders
+    with inflight_lock:
+        live_renders += delta
+        if live_renders:
+            live_renders_idle.clear()
+        else:
+            live_renders_idle.set()
+
+def single_flight(key, compute, token):
+    with inflight_lock:
+        flight = inflight_renders.get(key)
+        leader = flight is None
+        if leader:
+            flight = {'done': threading.Event(), 'result': None, 'error': None, 'tokens': [token]}
+            inflight_renders[key] = flight
+        else:
+            flight['tokens'].append(token)
+
+    if not leader:
+        if token is not None:
+            _track_live_render(1)
+        try:
+            flight['done'].wait()
+        finally:
+            if token is not None:
+                _track_live_render(-1)
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    def should_abandon():
+        while True:
+            with inflight_lock:
+                live = [t for t in flight['tokens'] if t is not None]
+                if live and len(live) == len(flight['tokens']):
+                    return all(render_generations.get(slot) != generation for slot, generation in live)
+            if live or live_renders_idle.wait(BACKGROUND_YIELD_POLL):
+                return False
+
+    if token is not None:
+        _track_live_render(1)
+    try:
+        flight['result'] = compute(should_abandon)
+        return flight['result']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        if token is not None:
+            _track_live_render(-1)
+        with inflight_lock:
+            inflight_renders.pop(key, None)
+        flight['done'].set()
+
 # =====================
 # YOUR CALLBACKS
 # =====================
@@ -537,26 +1390,72 @@ def on_thumb_click(click1, click2, click3, click4, click5, current_main):
 
 @dash_app.callback(
     [Output('main-graph', 'figure')] +
-    [Output(f'thumb-{i}', 'figure') for i in range(1,6)] +
+    [Output(f'thumb-{i}', 'src' if SVG_THUMBNAILS else 'figure') for i in range(1,6)] +
     [Output('kpi-total-patients', 'children'),
      Output('kpi-avg-logins', 'children'),
      Output('kpi-satisfaction', 'children'),
      Output('kpi-mobile', 'children'),
      Output('kpi-feature-utilization', 'children')],  # NEW OUTPUT ADDED
     [Input('clinic-filter','value'), Input('age-filter','value'), Input('gender-filter','value'),
+     Input('barrier-filter','value'), Input('mobile-filter','value'),
      Input('main-chart-index', 'data')]
 )
-def render_charts(clinic_val, age_val, gender_val, main_idx):
-    df = merged_data.copy()
-    if clinic_val != 'all':
-        df = df[df['clinic'] == clinic_val]
-    if age_val != 'all':
-        df = df[df['age_group'] == age_val]
-    if gender_val != 'all':
-        df = df[df['gender'] == gender_val]
+def render_charts(clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals, main_idx):
+    key = (filter_key(clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals), main_idx)
+    # Taken before the cache lookup so a cache hit still supersedes older renders
+    token = next_render_token('render_charts')
+    try:
+        result = dashboard_cache_get(key)
+        if result is None and refresh_dashboard_cache():
+            result = dashboard_cache_get(key)
+        if result is not None:
+            return result
+
+        while True:
+            try:
+                result = single_flight(key, lambda should_abandon: compute_dashboard(*key, should_abandon), token)
+                dashboard_cache_put(key, result)
+                break
+            except RenderAbandoned:
+                # Every request sharing the computation was superseded; retry only if this one wasn't
+                if render_token_stale(token):
+                    raise PreventUpdate
+        if render_token_stale(token):
+            raise PreventUpdate
+        return result
+    finally:
+        release_render_token(token)
+
+def empty_chart(size='large'):
+    fig = go.Figure()
+    fig.update_layout(
+        template='plotly_white',
+        height=500 if size == 'large' else 140,
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False),
+        annotations=[dict(text='No patients match these filters', showarrow=False,
+                          font=dict(size=14 if size == 'large' else 9))]
+    )
+    return fig
 
+def compute_dashboard(filters, main_idx, should_abandon=None):
+    def checkpoint():
+        if should_abandon is not None and should_abandon():
+            raise RenderAbandoned()
+
+    bits = filter_bitset(filters)
+    thumb_indices = [i for i in range(6) if i != main_idx]
+
+    if bitset_count(bits) == 0:
+        thumbs = ([thumbnail_url(filters, i) for i in thumb_indices] if SVG_THUMBNAILS
+                  else [empty_chart('small').to_dict() for i in thumb_indices])
+        return [empty_chart('large').to_dict()] + thumbs + ['0', '0.0', '-', '-', '-']
+
+    df = merged_data if filters == ALL_FILTERS else merged_data.take(bitset_rows(bits))
+
+    checkpoint()
     total_patients = df['patient_id'].nunique()
-    avg_logins = df.groupby('patient_id')['logins'].mean().mean()
+    avg_logins = df.groupby('patient_id', observed=True)['logins'].mean().mean()
     avg_satisfaction = df['portal_satisfaction_1_5'].mean()
     mobile_users = df['prefers_mobile_app'].mean() * 100
     
@@ -568,7 +1467,7 @@ def render_charts(clinic_val, age_val, gender_val, main_idx):
 
     # Create all charts
     chart_functions = [
-        create_trend_chart,
+        partial(create_trend_chart, filters=filters),
         create_clinic_chart,
         create_feature_chart,
         create_demographic_chart,
@@ -576,13 +1475,20 @@ def render_charts(clinic_val, age_val, gender_val, main_idx):
         create_barriers_chart
     ]
 
+    checkpoint()
     main_fig = chart_functions[main_idx](df, 'large')
     main_fig.update_layout(transition={'duration': 500, 'easing': 'cubic-in-out'})
 
-    thumb_indices = [i for i in range(6) if i != main_idx]
-    thumb_figs = [chart_functions[i](df, 'small') for i in thumb_indices]
+    if SVG_THUMBNAILS:
+        thumb_figs = [thumbnail_url(filters, i) for i in thumb_indices]
+    else:
+        thumb_figs = []
+        for i in thumb_indices:
+            checkpoint()
+            thumb_figs.append(chart_functions[i](df, 'small').to_dict())
 
-    return [main_fig] + thumb_figs + [
+    # Figures are stored as plain dicts so cached results serialise to JSON
+    return [main_fig.to_dict()] + thumb_figs + [
         f"{total_patients:,}",
         f"{avg_logins:.1f}",
         f"{avg_satisfaction:.1f}/5",
@@ -590,10 +1496,590 @@ def render_charts(clinic_val, age_val, gender_val, main_idx):
         f"{feature_utilization_rate:.1f}%"  # NEW KPI VALUE
     ]
 
+# =====================
+# DASHBOARD CACHE WARM-UP
+# =====================
+
+# Every clinic x age x gender x main-chart state is precomputed and written to
+# DASHBOARD_CACHE_DIR, keyed by dataset version. The preferred way is once, out of
+# process, before the workers start:
+#     python main.py warm-cache
+# With DASHBOARD_WARMUP=1 a single process per cache directory (whichever takes the
+# lock file) warms in the background instead, pausing whenever a live render is
+# computing. Other processes pick up the saved file on their next cache miss.
+DASHBOARD_WARMUP = os.environ.get('DASHBOARD_WARMUP', '0') == '1'
+DASHBOARD_WARMUP_WORKERS = int(os.environ.get('DASHBOARD_WARMUP_WORKERS', 1))
+DASHBOARD_CACHE_DIR = os.environ.get('DASHBOARD_CACHE_DIR', os.path.join(server.instance_path, 'dashboard-cache'))
+DASHBOARD_CACHE_SIZE = int(os.environ.get('DASHBOARD_CACHE_SIZE', 2048))
+DASHBOARD_CACHE_SAVE_INTERVAL = 30
+
+dataset_version = hashlib.sha256(
+    pd.util.hash_pandas_object(merged_data, index=True).values.tobytes()
+).hexdigest()[:16]
+
+dashboard_cache = OrderedDict()
+dashboard_cache_lock = threading.Lock()
+dashboard_cache_mtime = None
+
+def dashboard_cache_get(key):
+    with dashboard_cache_lock:
+        result = dashboard_cache.get(key)
+        if result is not None:
+            dashboard_cache.move_to_end(key)
+        return result
+
+def dashboard_cache_put(key, result):
+    with dashboard_cache_lock:
+        dashboard_cache[key] = result
+        dashboard_cache.move_to_end(key)
+        while len(dashboard_cache) > DASHBOARD_CACHE_SIZE:
+            dashboard_cache.popitem(last=False)
+
+def dashboard_cache_path():
+    return os.path.join(DASHBOARD_CACHE_DIR, f'dashboard-v3-{SVG_THUMBNAILS:d}-{dataset_version}.json')
+
+def _cache_key(value):
+    # JSON turns the nested key tuples into lists
+    return tuple(_cache_key(v) for v in value) if isinstance(value, list) else value
+
+def load_dashboard_cache():
+    # Plain JSON, so reading a cache file can never run code
+    global dashboard_cache_mtime
+    try:
+        private_dir(DASHBOARD_CACHE_DIR)
+        mtime = os.path.getmtime(dashboard_cache_path())
+        with open(dashboard_cache_path(), encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print(f"Could not load dashboard cache: {e}")
+        return False
+    dashboard_cache_mtime = mtime
+    for key, result in entries:
+        key = _cache_key(key)
+        if dashboard_cache_get(key) is None:
+            dashboard_cache_put(key, result)
+    print(f"Dashboard cache loaded ({len(entries)} entries)")
+    return True
+
+def refresh_dashboard_cache():
+    # One stat per cache miss; reloads only when another process saved a newer file
+    try:
+        mtime = os.path.getmtime(dashboard_cache_path())
+    except OSError:
+        return False
+    return mtime != dashboard_cache_mtime and load_dashboard_cache()
+
+def save_dashboard_cache():
+    global dashboard_cache_mtime
+    private_dir(DASHBOARD_CACHE_DIR)
+    with dashboard_cache_lock:
+        entries = list(dashboard_cache.items())
+    tmp_path = f"{dashboard_cache_path()}.{os.getpid()}.tmp"
+    with open_private(tmp_path, encoding='utf-8') as f:
+        json.dump(entries, f, cls=plotly.utils.PlotlyJSONEncoder)
+    os.replace(tmp_path, dashboard_cache_path())
+    dashboard_cache_mtime = os.path.getmtime(dashboard_cache_path())
+
+def warmup_keys():
+    # "All" plus every single clinic / age group / gender; multi-value selections
+    # and the barrier and mobile filters are left to the live callback
+    clinics = [()] + [(v,) for v in filter_index['clinic']]
+    ages = [()] + [(v,) for v in filter_index['age']]
+    genders = [()] + [(v,) for v in filter_index['gender']]
+    return [((c, a, g, (), ()), m) for c in clinics for a in ages for g in genders for m in range(6)]
+
+def _warmup_worker(tasks):
+    while True:
+        try:
+            key = tasks.get_nowait()
+        except queue.Empty:
+            return
+        if dashboard_cache_get(key) is not None:
+            continue
+        try:
+            # Shares the computation with any live request for the same key
+            result = single_flight(key, lambda should_abandon: compute_dashboard(*key, should_abandon), None)
+            dashboard_cache_put(key, result)
+            if SVG_THUMBNAILS:
+                for i in range(6):
+                    if i != key[1]:
+                        live_renders_idle.wait()
+                        render_thumbnail_svg(key[0], i)
+        except Exception as e:
+            print(f"Dashboard warm-up skipped {key}: {e}")
+
+def warm_dashboard_cache():
+    started = time.time()
+    keys = warmup_keys()
+    tasks = queue.Queue()
+    for key in keys:
+        tasks.put(key)
+
+    workers = [threading.Thread(target=_warmup_worker, args=(tasks,), daemon=True)
+               for _ in range(max(1, DASHBOARD_WARMUP_WORKERS))]
+    for worker in workers:
+        worker.start()
+    # Saved periodically so other processes can pick up partial results
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(DASHBOARD_CACHE_SAVE_INTERVAL)
+            if worker.is_alive():
+                try:
+                    save_dashboard_cache()
+                except OSError as e:
+                    print(f"Could not save dashboard cache: {e}")
+
+    print(f"Dashboard cache warmed: {len(keys)} combinations in {time.time() - started:.1f}s")
+    try:
+        save_dashboard_cache()
+    except OSError as e:
+        print(f"Could not save dashboard cache: {e}")
+
+def claim_warmup():
+    # The lock is held by an open file for the life of the process, so it is
+    # released even if the warming process dies
+    global warmup_lock_file
+    if fcntl is None:
+        return True
+    try:
+        private_dir(DASHBOARD_CACHE_DIR)
+    except OSError as e:
+        print(f"Dashboard warm-up disabled: {e}")
+        return False
+    warmup_lock_file = open(f"{dashboard_cache_path()}.lock", 'w')
+    try:
+        fcntl.flock(warmup_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        warmup_lock_file.close()
+        return False
+
+load_dashboard_cache()
+if DASHBOARD_WARMUP and not (__name__ == '__main__' and sys.argv[1:] == ['warm-cache']) and claim_warmup():
+    threading.Thread(target=warm_dashboard_cache, name='dashboard-warmup', daemon=True).start()
+
+@dash_app.callback(
+    [Output('drilldown-table', 'data'),
+     Output('drilldown-table', 'page_count'),
+     Output('drilldown-count', 'children')],
+    [Input('drilldown-table', 'page_current'), Input('drilldown-table', 'page_size'),
+     Input('drilldown-table', 'sort_by'), Input('drilldown-table', 'filter_query'),
+     Input('clinic-filter','value'), Input('age-filter','value'), Input('gender-filter','value'),
+     Input('barrier-filter','value'), Input('mobile-filter','value')]
+)
+def update_drilldown(page_current, page_size, sort_by, filter_query,
+                     clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals):
+    filters = filter_key(clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals)
+    sort_column = sort_by[0]['column_id'] if sort_by else None
+    descending = bool(sort_by) and sort_by[0]['direction'] == 'desc'
+    positions = drilldown_positions(filters, sort_column, descending, filter_query or '')
+
+    page_size = page_size or DRILLDOWN_PAGE_SIZE
+    page_count = max(1, -(-len(positions) // page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    start = page_current * page_size
+
+    return (drilldown_records(positions[start:start + page_size]),
+            page_count,
+            f"{len(positions):,} matching rows")
+
+# Sort indexes and cached drill-down views are built on use, so the report is
+# recomputed whenever the panel is toggled
+@dash_app.callback(
+    Output('memory-report', 'data'),
+    Input('memory-details', 'n_clicks'),
+    prevent_initial_call=True
+)
+def update_memory_report(n_clicks):
+    return memory_report_rows()
+
+@dash_app.callback(
+    [Output('cohort-kpis', 'data'),
+     Output('cohort-satisfaction', 'figure'),
+     Output('cohort-features', 'figure'),
+     Output('cohort-summary', 'children')],
+    [Input('cohort-a', 'value'), Input('cohort-b', 'value')]
+)
+def update_cohorts(cohort_a, cohort_b):
+    filters_a = cohort_filters(cohort_a)
+    filters_b = None if COHORT_REST in (cohort_b or []) else cohort_filters(cohort_b)
+    comparison = compare_cohorts(filters_a, filters_b)
+    satisfaction_fig, feature_fig = cohort_charts(comparison)
+    rows_a, rows_b = comparison['rows']
+    summary = f"Cohort A: {rows_a:,} rows · Cohort B: {rows_b:,} rows"
+    if comparison['shared_patients']:
+        summary += f" · {comparison['shared_patients']:,} patients in both"
+    return cohort_kpi_rows(comparison), satisfaction_fig, feature_fig, summary
+
+# =====================
+# EXPORT JOBS
+# =====================
+
+# Exports of the filtered slice run on a small executor and are written in chunks
+# to EXPORT_DIR; finished files are swept by age and total size. They are row-level
+# patient data, so the directory is private (0700) and files are written 0600.
+EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(server.instance_path, 'exports'))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))
+EXPORT_MAX_AGE = int(os.environ.get('EXPORT_MAX_AGE', 3600))
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', 512 * 1024 * 1024))
+EXPORT_CHUNK_ROWS = 50000
+XLSX_MAX_ROWS = 1048575
+
+export_jobs = {}
+export_jobs_lock = threading.Lock()
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+
+def update_export_job(job_id, **fields):
+    with export_jobs_lock:
+        export_jobs[job_id].update(fields)
+
+def get_export_job(job_id, owner):
+    with export_jobs_lock:
+        job = export_jobs.get(job_id)
+        return dict(job) if job and job['owner'] == owner else None
+
+def _export_chunks(positions):
+    for start in range(0, len(positions), EXPORT_CHUNK_ROWS):
+        yield start, flags_as_int(merged_data.iloc[positions[start:start + EXPORT_CHUNK_ROWS]][DRILLDOWN_COLUMNS])
+
+def _write_csv(job_id, positions, path):
+    with open_private(path, newline='', encoding='utf-8') as f:
+        for start, chunk in _export_chunks(positions):
+            chunk.to_csv(f, header=start == 0, index=False)
+            update_export_job(job_id, progress=(start + len(chunk)) / len(positions))
+
+def _write_xlsx(job_id, positions, path):
+    if len(positions) > XLSX_MAX_ROWS:
+        raise ValueError(f"{len(positions):,} rows exceed the XLSX sheet limit; export as CSV instead")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('merged_data')
+    sheet.append(DRILLDOWN_COLUMNS)
+    for start, chunk in _export_chunks(positions):
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False):
+            sheet.append(list(row))
+        # Saving the workbook is the last step, so rows written only count for 90%
+        update_export_job(job_id, progress=0.9 * (start + len(chunk)) / len(positions))
+    with open_private(path, 'wb') as f:
+        workbook.save(f)
+
+def run_export_job(job_id, filters, fmt):
+    update_export_job(job_id, status='running')
+    path = os.path.join(EXPORT_DIR, f"{job_id}.{fmt}")
+    part_path = f"{path}.part"
+    try:
+        positions = bitset_rows(filter_bitset(filters))
+        if len(positions) == 0:
+            raise ValueError("No rows match the current filters")
+        (_write_csv if fmt == 'csv' else _write_xlsx)(job_id, positions, part_path)
+        os.replace(part_path, path)
+        update_export_job(job_id, status='done', progress=1.0, rows=len(positions),
+                          path=path, finished=time.time())
+    except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        update_export_job(job_id, status='failed', error=str(e), finished=time.time())
+    cleanup_exports()
+
+def submit_export_job(filters, fmt, owner):
+    if not owner:
+        raise ValueError("Exports need a signed-in owner")
+    private_dir(EXPORT_DIR)
+    cleanup_exports()
+    job_id = uuid.uuid4().hex
+    with export_jobs_lock:
+        export_jobs[job_id] = {
+            'id': job_id, 'owner': owner, 'format': fmt, 'status': 'queued', 'progress': 0.0,
+            'rows': None, 'path': None, 'error': None, 'created': time.time(), 'finished': None,
+            'filename': f"merged_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        }
+    export_executor.submit(run_export_job, job_id, filters, fmt)
+    return job_id
+
+def cleanup_exports():
+    now = time.time()
+    with export_jobs_lock:
+        finished = sorted((job for job in export_jobs.values() if job['finished']),
+                          key=lambda job: job['finished'])
+        expired = [job for job in finished if now - job['finished'] > EXPORT_MAX_AGE]
+        kept = [job for job in finished if job not in expired]
+        total_bytes = sum(os.path.getsize(job['path']) for job in kept
+                          if job['path'] and os.path.exists(job['path']))
+        # Oldest finished exports go first once the directory is over budget
+        while kept and total_bytes > EXPORT_MAX_BYTES:
+            job = kept.pop(0)
+            expired.append(job)
+            if job['path'] and os.path.exists(job['path']):
+                total_bytes -= os.path.getsize(job['path'])
+        for job in expired:
+            export_jobs.pop(job['id'], None)
+            if job['path'] and os.path.exists(job['path']):
+                os.remove(job['path'])
+        known_paths = {job['path'] for job in export_jobs.values()}
+        known_paths |= {os.path.join(EXPORT_DIR, f"{job['id']}.{job['format']}.part")
+                        for job in export_jobs.values() if job['status'] in ('queued', 'running')}
+
+    # Files left behind by a previous process (including .part files from a write
+    # that crashed) are swept by age only, and only from a directory that is ours
+    try:
+        private_dir(EXPORT_DIR)
+    except OSError:
+        return
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if path not in known_paths and now - os.path.getmtime(path) > EXPORT_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+@dash_app.callback(
+    Output('export-job-id', 'data'),
+    [Input('export-csv', 'n_clicks'), Input('export-xlsx', 'n_clicks')],
+    [State('clinic-filter','value'), State('age-filter','value'), State('gender-filter','value'),
+     State('barrier-filter','value'), State('mobile-filter','value')],
+    prevent_initial_call=True
+)
+def start_export(csv_clicks, xlsx_clicks, clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals):
+    if session.get('role') != 'admin':
+        raise PreventUpdate
+    fmt = 'xlsx' if callback_context.triggered[0]['prop_id'].startswith('export-xlsx') else 'csv'
+    filters = filter_key(clinic_vals, age_vals, gender_vals, barrier_vals, mobile_vals)
+    return submit_export_job(filters, fmt, session['user'])
+
+@dash_app.callback(
+    [Output('export-status', 'children'), Output('export-poll', 'disabled')],
+    [Input('export-job-id', 'data'), Input('export-poll', 'n_intervals')]
+)
+def poll_export(job_id, n_intervals):
+    if not job_id:
+        return '', True
+    job = get_export_job(job_id, session.get('user'))
+    if job is None:
+        return 'Export expired', True
+    if job['status'] == 'done':
+        return html.A(f"Download {job['format'].upper()} ({job['rows']:,} rows)",
+                      href=f"/admin-exports/{job_id}/download"), True
+    if job['status'] == 'failed':
+        return f"Export failed: {job['error']}", True
+    return f"Exporting {job['format'].upper()}... {job['progress'] * 100:.0f}%", False
+
+# =====================
+# APPOINTMENT AVAILABILITY
+# =====================
+
+# Each doctor's bookings are kept as parallel lists sorted by start time. Bookings
+# never overlap, so ends are sorted too: a conflict check is one bisect and slot
+# search only walks the bookings inside the requested range.
+APPOINTMENT_LENGTH = timedelta(minutes=30)
+CLINIC_OPEN_HOUR, CLINIC_CLOSE_HOUR = 9, 17
+MAX_AVAILABILITY_DAYS = 92
+
+doctor_calendars = {}
+schedule_lock = threading.Lock()
+
+def _calendar(doctor):
+    return doctor_calendars.setdefault(doctor, {'starts': [], 'ends': [], 'ids': []})
+
+def _find_conflict(calendar, start, end, ignore_id=None):
+    i = bisect.bisect_left(calendar['starts'], end) - 1
+    if i >= 0 and calendar['ids'][i] == ignore_id:
+        i -= 1
+    return i >= 0 and calendar['ends'][i] > start
+
+def slot_problem(start):
+    # Same rules free_slots offers slots by, so anything it lists is bookable and nothing else is
+    day_open = start.replace(hour=CLINIC_OPEN_HOUR, minute=0, second=0, microsecond=0)
+    if start < datetime.now():
+        return 'That time has already passed'
+    if start.weekday() >= 5:
+        return 'The clinic is closed on weekends'
+    if start < day_open or start + APPOINTMENT_LENGTH > start.replace(hour=CLINIC_CLOSE_HOUR, minute=0, second=0,
+                                                                      microsecond=0):
+        return f'Appointments run from {CLINIC_OPEN_HOUR}:00 to {CLINIC_CLOSE_HOUR}:00'
+    if (start - day_open) % APPOINTMENT_LENGTH:
+        return f'Appointments start on the {APPOINTMENT_LENGTH.seconds // 60}-minute slot grid'
+    return None
+
+def _insert_booking(calendar, start, end, booking_id):
+    i = bisect.bisect_left(calendar['starts'], start)
+    calendar['starts'].insert(i, start)
+    calendar['ends'].insert(i, end)
+    calendar['ids'].insert(i, booking_id)
+
+def _remove_booking(calendar, start, booking_id):
+    i = bisect.bisect_left(calendar['starts'], start)
+    while i < len(calendar['starts']) and calendar['starts'][i] == start:
+        if calendar['ids'][i] == booking_id:
+            del calendar['starts'][i], calendar['ends'][i], calendar['ids'][i]
+            return True
+        i += 1
+    return False
+
+def doctor_directory():
+    doctors = {}
+    for appointment in appointments_data['upcoming'] + appointments_data['past']:
+        doctors.setdefault(appointment['doctor'], appointment['specialty'])
+    return doctors
+
+def seed_doctor_calendars(days=60):
+    # Other patients' bookings so availability looks like a real schedule
+    rng = random.Random(7)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for doctor in doctor_directory():
+        calendar = _calendar(doctor)
+        for day in range(1, days + 1):
+            date = today + timedelta(days=day)
+            if date.weekday() >= 5:
+                continue
+            slot = date.replace(hour=CLINIC_OPEN_HOUR)
+            while slot + APPOINTMENT_LENGTH <= date.replace(hour=CLINIC_CLOSE_HOUR):
+                if rng.random() < 0.4:
+                    _insert_booking(calendar, slot, slot + APPOINTMENT_LENGTH, f"booked-{doctor}-{slot:%Y%m%d%H%M}")
+                slot += APPOINTMENT_LENGTH
+    for appointment in appointments_data['upcoming']:
+        start = appointment['datetime'].replace(second=0, microsecond=0)
+        calendar = _calendar(appointment['doctor'])
+        # The demo appointments take precedence over any generated booking they collide with
+        i = bisect.bisect_left(calendar['starts'], start + APPOINTMENT_LENGTH) - 1
+        while i >= 0 and calendar['ends'][i] > start:
+            del calendar['starts'][i], calendar['ends'][i], calendar['ids'][i]
+            i -= 1
+        _insert_booking(calendar, start, start + APPOINTMENT_LENGTH, appointment['id'])
+        appointment['datetime'] = start
+
+def free_slots(doctor, range_start, range_end):
+    calendar = _calendar(doctor)
+    slots = []
+    day = range_start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < range_end:
+        if day.weekday() < 5:
+            slot = max(day.replace(hour=CLINIC_OPEN_HOUR), range_start)
+            close = min(day.replace(hour=CLINIC_CLOSE_HOUR), range_end)
+            # Align to the slot grid, then walk bookings from the first that could overlap
+            offset = (slot - day.replace(hour=CLINIC_OPEN_HOUR)) % APPOINTMENT_LENGTH
+            if offset:
+                slot += APPOINTMENT_LENGTH - offset
+            i = bisect.bisect_right(calendar['ends'], slot)
+            while slot + APPOINTMENT_LENGTH <= close:
+                while i < len(calendar['starts']) and calendar['ends'][i] <= slot:
+                    i += 1
+                if i < len(calendar['starts']) and calendar['starts'][i] < slot + APPOINTMENT_LENGTH:
+                    slot = max(slot + APPOINTMENT_LENGTH, calendar['ends'][i])
+                    offset = (slot - day.replace(hour=CLINIC_OPEN_HOUR)) % APPOINTMENT_LENGTH
+                    if offset:
+                        slot += APPOINTMENT_LENGTH - offset
+                    continue
+                slots.append((slot, slot + APPOINTMENT_LENGTH))
+                slot += APPOINTMENT_LENGTH
+        day += timedelta(days=1)
+    return slots
+
+def to_local_naive(value):
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+seed_doctor_calendars()
+
+@server.route('/availability')
+def availability():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    directory = doctor_directory()
+    doctor = request.args.get('doctor')
+    specialty = request.args.get('specialty')
+    if doctor:
+        doctors = [doctor] if doctor in directory else []
+    else:
+        doctors = [d for d, s in directory.items() if s == specialty]
+    if not doctors:
+        return jsonify({'success': False, 'message': 'No matching doctor'})
+
+    try:
+        start = datetime.fromisoformat(request.args.get('start', ''))
+        end = datetime.fromisoformat(request.args['end']) + timedelta(days=1) if request.args.get('end') \
+            else start + timedelta(days=7)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid date range'})
+    start, end = max(to_local_naive(start), datetime.now()), to_local_naive(end)
+    if end - start > timedelta(days=MAX_AVAILABILITY_DAYS):
+        return jsonify({'success': False, 'message': f'Date range is limited to {MAX_AVAILABILITY_DAYS} days'})
+
+    slots = []
+    with schedule_lock:
+        for d in doctors:
+            slots += [{'doctor': d, 'specialty': directory[d],
+                       'start': slot_start.isoformat(timespec='minutes'),
+                       'end': slot_end.isoformat(timespec='minutes')}
+                      for slot_start, slot_end in free_slots(d, start, end)]
+    slots.sort(key=lambda slot: (slot['start'], slot['doctor']))
+    return jsonify({'success': True, 'slots': slots})
+
 # =====================
 # NEW FLASK ROUTES FOR FUNCTIONALITY
 # =====================
 
+# Dash registers its own routes under /admin-dashboard/ (layout, _dash-update-component,
+# assets), so they are guarded here rather than per view
+@server.before_request
+def require_admin_for_dashboard():
+    if not request.path.startswith('/admin-dashboard/'):
+        return None
+    if 'user' in session and session.get('role') == 'admin':
+        return None
+    if '/_dash-' in request.path:
+        return jsonify({'success': False, 'message': 'Not authenticated'}), 403
+    return redirect('/')
+
+@server.route('/admin-memory-report')
+def admin_memory_report():
+    if 'user' not in session or session['role'] != 'admin':
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    return jsonify({'success': True, 'compact_dtypes': COMPACT_DTYPES, 'rows': len(merged_data),
+                    'columns': memory_report_rows()})
+
+@server.route('/admin-exports/<job_id>')
+def admin_export_status(job_id):
+    if 'user' not in session or session['role'] != 'admin':
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    job = get_export_job(job_id, session['user'])
+    if job is None:
+        return jsonify({'success': False, 'message': 'Export not found'})
+    return jsonify({'success': True, **{k: job[k] for k in ('id', 'format', 'status', 'progress', 'rows', 'error')}})
+
+@server.route('/admin-exports/<job_id>/download')
+def admin_export_download(job_id):
+    if 'user' not in session or session['role'] != 'admin':
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    job = get_export_job(job_id, session['user'])
+    if job is None or job['status'] != 'done' or not os.path.exists(job['path']):
+        return jsonify({'success': False, 'message': 'Export not found'})
+
+    mimetype = 'text/csv' if job['format'] == 'csv' else \
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return send_file(job['path'], as_attachment=True, download_name=job['filename'], mimetype=mimetype)
+
+@server.route('/admin-dashboard-thumbs/<int:chart_idx>.svg')
+def admin_dashboard_thumb(chart_idx):
+    if 'user' not in session or session['role'] != 'admin':
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    if not 0 <= chart_idx < len(svg_thumb_functions):
+        return jsonify({'success': False, 'message': 'Chart not found'})
+
+    try:
+        filters = filter_key(*[request.args.getlist(name) for name in FILTER_COLUMNS])
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid filter'})
+
+    svg = render_thumbnail_svg(filters, chart_idx)
+    response = Response(svg, mimetype='image/svg+xml')
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response
+
 @server.route('/reschedule-appointment', methods=['POST'])
 def reschedule_appointment():
     if 'user' not in session:
@@ -605,20 +2091,34 @@ def reschedule_appointment():
     
     try:
         # Parse the ISO format datetime from frontend
-        new_datetime = datetime.fromisoformat(new_date.replace('Z', '+00:00'))
+        new_datetime = to_local_naive(datetime.fromisoformat(new_date.replace('Z', '+00:00')))
+        new_datetime = new_datetime.replace(second=0, microsecond=0)
         
         # Format it for display
         formatted_date = new_datetime.strftime('%b %d, %Y - %I:%M %p')
         
-        # Find and update appointment
-        for appointment in appointments_data['upcoming']:
-            if appointment['id'] == appointment_id:
-                appointment['date'] = formatted_date
-                appointment['datetime'] = new_datetime
-                return jsonify({
-                    'success': True, 
-                    'message': f'Appointment rescheduled to {formatted_date}'
-                })
+        # Slot checks and the move happen under one lock so two reschedules can't take the same slot
+        with schedule_lock:
+            for appointment in appointments_data['upcoming']:
+                if appointment['id'] == appointment_id:
+                    problem = slot_problem(new_datetime)
+                    if problem:
+                        return jsonify({'success': False, 'message': f"{problem}. Please pick another slot."})
+                    calendar = _calendar(appointment['doctor'])
+                    new_end = new_datetime + APPOINTMENT_LENGTH
+                    if _find_conflict(calendar, new_datetime, new_end, ignore_id=appointment_id):
+                        return jsonify({
+                            'success': False,
+                            'message': f"{appointment['doctor']} is not available at {formatted_date}. Please pick another slot."
+                        })
+                    _remove_booking(calendar, appointment['datetime'], appointment_id)
+                    _insert_booking(calendar, new_datetime, new_end, appointment_id)
+                    appointment['date'] = formatted_date
+                    appointment['datetime'] = new_datetime
+                    return jsonify({
+                        'success': True, 
+                        'message': f'Appointment rescheduled to {formatted_date}'
+                    })
         
         return jsonify({'success': False, 'message': 'Appointment not found'})
         
@@ -644,15 +2144,17 @@ def cancel_appointment():
     appointment_id = data.get('appointment_id')
     
     # Find and remove appointment
-    for i, appointment in enumerate(appointments_data['upcoming']):
-        if appointment['id'] == appointment_id:
-            cancelled_appointment = appointments_data['upcoming'].pop(i)
-            appointments_data['past'].append({
-                **cancelled_appointment,
-                'summary': 'Appointment was cancelled by patient.',
-                'date': f"Cancelled - {cancelled_appointment['date']}"
-            })
-            return jsonify({'success': True, 'message': 'Appointment cancelled successfully'})
+    with schedule_lock:
+        for i, appointment in enumerate(appointments_data['upcoming']):
+            if appointment['id'] == appointment_id:
+                cancelled_appointment = appointments_data['upcoming'].pop(i)
+                _remove_booking(_calendar(appointment['doctor']), appointment['datetime'], appointment_id)
+                appointments_data['past'].append({
+                    **cancelled_appointment,
+                    'summary': 'Appointment was cancelled by patient.',
+                    'date': f"Cancelled - {cancelled_appointment['date']}"
+                })
+                return jsonify({'success': True, 'message': 'Appointment cancelled successfully'})
     
     return jsonify({'success': False, 'message': 'Appointment not found'})
 
@@ -677,14 +2179,12 @@ def get_appointment_summary():
     
     return jsonify({'success': False, 'message': 'Appointment summary not found'})
 
-@server.route('/download-record/<record_type>/<int:record_id>')
-def download_record(record_type, record_id):
-    if 'user' not in session:
-        return jsonify({'success': False, 'message': 'Not authenticated'})
-    
+# Download bodies are built by plain functions so the ASGI handlers in asgi.py
+# can serve the same content without a Flask request
+def record_content(record_type, patient_name):
     # Create a simple text file for demo purposes
     content = f"Medical Record - {record_type.upper()}\n"
-    content += f"Patient: {session.get('name', 'Unknown')}\n"
+    content += f"Patient: {patient_name}\n"
     content += f"Download Date: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
     content += "="*50 + "\n"
     
@@ -700,25 +2200,12 @@ def download_record(record_type, record_id):
         content += "This would contain imaging findings in a real system.\n"
     
     content += "\nThis is a demo file. In a real system, this would be a properly formatted medical document."
-    
-    # Create file in memory
-    file_like = io.BytesIO(content.encode('utf-8'))
-    
-    return send_file(
-        file_like,
-        as_attachment=True,
-        download_name=f"{record_type}_record_{record_id}.txt",
-        mimetype='text/plain'
-    )
+    return content
 
-@server.route('/download-all-records')
-def download_all_records():
-    if 'user' not in session:
-        return jsonify({'success': False, 'message': 'Not authenticated'})
-    
+def all_records_content(patient_name):
     # Create comprehensive record file
     content = f"COMPLETE MEDICAL RECORDS\n"
-    content += f"Patient: {session.get('name', 'Unknown')}\n"
+    content += f"Patient: {patient_name}\n"
     content += f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
     content += "="*50 + "\n\n"
     
@@ -731,8 +2218,66 @@ def download_all_records():
     content += "- Immunization records\n"
     content += "- Medical history\n\n"
     content += "For security and privacy, actual medical records would be properly formatted and encrypted."
+    return content
+
+def receipt_content(payment, patient_name):
+    # Create receipt content
+    content = f"MEDICAL PAYMENT RECEIPT\n"
+    content += "="*50 + "\n"
+    content += f"Patient: {patient_name}\n"
+    content += f"Receipt ID: {payment['id']}\n"
+    content += f"Date: {payment['date']}\n"
+    content += f"Description: {payment['description']}\n"
+    content += f"Amount: ${payment['amount']:.2f}\n"
+    content += f"Status: {payment['status']}\n"
+    content += "="*50 + "\n"
+    content += "Thank you for your payment!\n"
+    content += "Hospital Billing Department\n"
+    content += f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
+    return content
+
+def statements_content(patient_name):
+    # Create statements content
+    content = f"BILLING STATEMENTS\n"
+    content += "="*50 + "\n"
+    content += f"Patient: {patient_name}\n"
+    content += f"Period: January 2024 - December 2024\n"
+    content += "="*50 + "\n\n"
+    
+    total_amount = sum(p['amount'] for p in payment_history)
+    
+    for payment in payment_history:
+        content += f"Date: {payment['date']}\n"
+        content += f"Service: {payment['description']}\n"
+        content += f"Amount: ${payment['amount']:.2f}\n"
+        content += f"Status: {payment['status']}\n"
+        content += "-" * 30 + "\n"
+    
+    content += f"\nTotal Amount: ${total_amount:.2f}\n"
+    content += "All payments are complete and up to date.\n"
+    return content
+
+@server.route('/download-record/<record_type>/<int:record_id>')
+def download_record(record_type, record_id):
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    
+    # Create file in memory
+    file_like = io.BytesIO(record_content(record_type, session.get('name', 'Unknown')).encode('utf-8'))
+    
+    return send_file(
+        file_like,
+        as_attachment=True,
+        download_name=f"{record_type}_record_{record_id}.txt",
+        mimetype='text/plain'
+    )
+
+@server.route('/download-all-records')
+def download_all_records():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
     
-    file_like = io.BytesIO(content.encode('utf-8'))
+    file_like = io.BytesIO(all_records_content(session.get('name', 'Unknown')).encode('utf-8'))
     
     return send_file(
         file_like,
@@ -751,21 +2296,7 @@ def download_receipt(receipt_id):
     if not payment:
         return jsonify({'success': False, 'message': 'Receipt not found'})
     
-    # Create receipt content
-    content = f"MEDICAL PAYMENT RECEIPT\n"
-    content += "="*50 + "\n"
-    content += f"Patient: {session.get('name', 'Unknown')}\n"
-    content += f"Receipt ID: {receipt_id}\n"
-    content += f"Date: {payment['date']}\n"
-    content += f"Description: {payment['description']}\n"
-    content += f"Amount: ${payment['amount']:.2f}\n"
-    content += f"Status: {payment['status']}\n"
-    content += "="*50 + "\n"
-    content += "Thank you for your payment!\n"
-    content += "Hospital Billing Department\n"
-    content += f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
-    
-    file_like = io.BytesIO(content.encode('utf-8'))
+    file_like = io.BytesIO(receipt_content(payment, session.get('name', 'Unknown')).encode('utf-8'))
     
     return send_file(
         file_like,
@@ -779,26 +2310,7 @@ def view_statements():
     if 'user' not in session:
         return jsonify({'success': False, 'message': 'Not authenticated'})
     
-    # Create statements content
-    content = f"BILLING STATEMENTS\n"
-    content += "="*50 + "\n"
-    content += f"Patient: {session.get('name', 'Unknown')}\n"
-    content += f"Period: January 2024 - December 2024\n"
-    content += "="*50 + "\n\n"
-    
-    total_amount = sum(p['amount'] for p in payment_history)
-    
-    for payment in payment_history:
-        content += f"Date: {payment['date']}\n"
-        content += f"Service: {payment['description']}\n"
-        content += f"Amount: ${payment['amount']:.2f}\n"
-        content += f"Status: {payment['status']}\n"
-        content += "-" * 30 + "\n"
-    
-    content += f"\nTotal Amount: ${total_amount:.2f}\n"
-    content += "All payments are complete and up to date.\n"
-    
-    file_like = io.BytesIO(content.encode('utf-8'))
+    file_like = io.BytesIO(statements_content(session.get('name', 'Unknown')).encode('utf-8'))
     
     return send_file(
         file_like,
@@ -836,6 +2348,257 @@ def billing_alerts():
         'message': f'{alert_type} alerts {"enabled" if enabled else "disabled"} successfully'
     })
 
+# =====================
+# SECURE MESSAGES
+# =====================
+
+# Messages are kept per patient in time order (ids come from one global counter,
+# so id order is time order). Pages are addressed by an opaque cursor rather than
+# an offset, and new messages are pushed over server-sent events so an idle inbox
+# costs no requests.
+MESSAGE_PAGE_SIZE = 20
+SSE_HEARTBEAT_SECONDS = 15
+# Streams served by the Flask route hold a thread each; gunicorn.conf.py sizes this
+# per worker from its thread count (0 for sync workers, which makes pages poll instead)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 200))
+
+message_threads = [
+    {'name': 'Dr. Sarah Johnson', 'department': 'Cardiology'},
+    {'name': 'Billing Department', 'department': 'Finance'},
+    {'name': 'Dr. Michael Chen', 'department': 'Primary Care'},
+    {'name': 'Hospital Administration', 'department': 'Administration'}
+]
+
+# (thread, sender, text, minutes ago) used to seed each new inbox
+sample_messages = [
+    ('Hospital Administration', 'them', 'New health resources are now available in your patient portal!', 10080),
+    ('Hospital Administration', 'them', "We've added articles about nutrition, exercise, and stress management.", 10079),
+    ('Hospital Administration', 'me', "Thank you! I'll check them out. The portal is very helpful.", 10070),
+    ('Hospital Administration', 'them', "We're glad to hear that! Let us know if you have any feedback.", 10060),
+    ('Dr. Michael Chen', 'them', 'Reminder: Your annual physical examination is scheduled for tomorrow at 10:00 AM.', 2900),
+    ('Dr. Michael Chen', 'me', 'Thanks for the reminder. Should I bring any specific documents?', 2890),
+    ('Dr. Michael Chen', 'them', 'Please bring your medication list and any questions you have about your health.', 2880),
+    ('Dr. Michael Chen', 'me', 'Will do. See you then!', 2870),
+    ('Billing Department', 'them', 'Dear patient, your payment of $150.00 has been successfully processed. Thank you!', 1500),
+    ('Billing Department', 'me', 'Thank you for the confirmation. Can you send me a receipt?', 1490),
+    ('Billing Department', 'them', 'Certainly! The receipt has been emailed to you and is also available in your billing documents.', 1480),
+    ('Billing Department', 'me', 'Perfect, received it. Thank you!', 1470),
+    ('Dr. Sarah Johnson', 'them', 'Hello, your recent blood test results are now available in your portal. Everything looks good!', 300),
+    ('Dr. Sarah Johnson', 'me', 'Thank you doctor. Should I schedule a follow-up appointment?', 298),
+    ('Dr. Sarah Johnson', 'them', "Yes, that would be good. Let's schedule one for next month to review your progress.", 295),
+    ('Dr. Sarah Johnson', 'me', "Great, I'll book it through the portal. Thanks!", 294),
+    ('Dr. Sarah Johnson', 'them', 'Your cholesterol levels have improved significantly since your last visit. '
+                                  'Keep up the good work with your diet and exercise.', 120)
+]
+
+auto_replies = [
+    "Thank you for your message. We'll get back to you soon.",
+    "I've noted your message. Is there anything else I can help with?",
+    "Thanks for the update!",
+    "I'll look into this and get back to you."
+]
+
+message_ids = itertools.count(1)
+message_store = {}
+message_store_lock = threading.Lock()
+open_streams = 0
+# Callbacks run after a patient's inbox changes; the async stream handlers in
+# asgi.py use them to wake their event loop instead of parking a thread
+message_listeners = {}
+
+def encode_cursor(message_id):
+    return base64.urlsafe_b64encode(str(message_id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return int(base64.urlsafe_b64decode(padded.encode()).decode())
+
+def _inbox(patient):
+    # Caller holds message_store_lock
+    inbox = message_store.get(patient)
+    if inbox is None:
+        inbox = {'ids': [], 'messages': [], 'threads': {}, 'changed': threading.Condition(message_store_lock)}
+        message_store[patient] = inbox
+        now = time.time()
+        for thread, sender, text, minutes_ago in sample_messages:
+            _append_message(inbox, thread, sender, text, now - minutes_ago * 60)
+    return inbox
+
+def _append_message(inbox, thread, sender, text, timestamp):
+    message = {'id': next(message_ids), 'thread': thread, 'sender': sender, 'text': text, 'timestamp': timestamp}
+    message['cursor'] = encode_cursor(message['id'])
+    inbox['ids'].append(message['id'])
+    inbox['messages'].append(message)
+    thread_index = inbox['threads'].setdefault(thread, {'ids': [], 'messages': []})
+    thread_index['ids'].append(message['id'])
+    thread_index['messages'].append(message)
+    return message
+
+def add_message(patient, thread, sender, text):
+    with message_store_lock:
+        inbox = _inbox(patient)
+        message = _append_message(inbox, thread, sender, text, time.time())
+        inbox['changed'].notify_all()
+        listeners = list(message_listeners.get(patient, ()))
+    for listener in listeners:
+        listener()
+    return message
+
+def subscribe_messages(patient, listener):
+    with message_store_lock:
+        message_listeners.setdefault(patient, set()).add(listener)
+
+def unsubscribe_messages(patient, listener):
+    with message_store_lock:
+        listeners = message_listeners.get(patient)
+        if listeners is not None:
+            listeners.discard(listener)
+            if not listeners:
+                del message_listeners[patient]
+
+def list_messages(patient, thread=None, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    # Returns one page in chronological order plus the cursor of the next older page
+    with message_store_lock:
+        inbox = _inbox(patient)
+        index = inbox['threads'].get(thread, {'ids': [], 'messages': []}) if thread else inbox
+        if after is not None:
+            start = bisect.bisect_right(index['ids'], after)
+            page = index['messages'][start:start + limit]
+            return page, None
+        end = bisect.bisect_left(index['ids'], before) if before is not None else len(index['ids'])
+        start = max(0, end - limit)
+        page = index['messages'][start:end]
+        return page, (page[0]['cursor'] if start > 0 else None)
+
+def latest_messages(patient):
+    with message_store_lock:
+        inbox = _inbox(patient)
+        return {thread: index['messages'][-1] for thread, index in inbox['threads'].items()}
+
+def wait_for_messages(patient, after, timeout):
+    with message_store_lock:
+        inbox = _inbox(patient)
+        inbox['changed'].wait_for(lambda: inbox['ids'] and inbox['ids'][-1] > after, timeout=timeout)
+        start = bisect.bisect_right(inbox['ids'], after)
+        return inbox['messages'][start:]
+
+def messages_after(patient, after):
+    with message_store_lock:
+        inbox = _inbox(patient)
+        return inbox['messages'][bisect.bisect_right(inbox['ids'], after):]
+
+def stream_start_id(patient, resume):
+    # Last-Event-ID (or ?after=) cursor to resume from; defaults to the newest message
+    try:
+        last_id = decode_cursor(resume) if resume else None
+    except ValueError:
+        last_id = None
+    if last_id is None:
+        with message_store_lock:
+            ids = _inbox(patient)['ids']
+            last_id = ids[-1] if ids else 0
+    return last_id
+
+def acquire_stream_slot(limit=None):
+    global open_streams
+    with message_store_lock:
+        if open_streams >= (SSE_MAX_STREAMS if limit is None else limit):
+            return False
+        open_streams += 1
+        return True
+
+def release_stream_slot():
+    global open_streams
+    with message_store_lock:
+        open_streams -= 1
+
+def sse_message_event(message):
+    return f"id: {message['cursor']}\nevent: message\ndata: {json.dumps(message)}\n\n"
+
+# Auto-replies are delivered by one shared thread rather than a timer thread per
+# message. The delay is fixed, so queue order is also due order.
+AUTO_REPLY_DELAY = 2.0
+auto_replies_pending = queue.Queue(maxsize=10000)
+
+def _auto_reply_worker():
+    while True:
+        due, patient, thread = auto_replies_pending.get()
+        time.sleep(max(0.0, due - time.time()))
+        try:
+            add_message(patient, thread, 'them', random.choice(auto_replies))
+        except Exception as e:
+            print(f"Auto-reply failed: {e}")
+
+threading.Thread(target=_auto_reply_worker, name='auto-reply', daemon=True).start()
+
+def schedule_auto_reply(patient, thread):
+    try:
+        auto_replies_pending.put_nowait((time.time() + AUTO_REPLY_DELAY, patient, thread))
+    except queue.Full:
+        pass
+
+@server.route('/api/messages', methods=['GET'])
+def api_list_messages():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    try:
+        before = decode_cursor(request.args['before']) if request.args.get('before') else None
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+        limit = min(max(int(request.args.get('limit', MESSAGE_PAGE_SIZE)), 1), 100)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor'})
+
+    page, next_cursor = list_messages(session['user'], request.args.get('thread'), before, after, limit)
+    return jsonify({'success': True, 'messages': page, 'next_cursor': next_cursor})
+
+@server.route('/api/messages', methods=['POST'])
+def api_send_message():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+
+    data = request.json or {}
+    thread = data.get('thread')
+    text = (data.get('text') or '').strip()
+    if thread not in {t['name'] for t in message_threads} or not text:
+        return jsonify({'success': False, 'message': 'Invalid message'})
+
+    message = add_message(session['user'], thread, 'me', text)
+    schedule_auto_reply(session['user'], thread)
+    return jsonify({'success': True, 'message': message})
+
+@server.route('/api/messages/stream')
+def api_message_stream():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not authenticated'})
+    patient = session['user']
+    last_id = stream_start_id(patient, request.headers.get('Last-Event-ID') or request.args.get('after'))
+
+    # Each open stream parks a worker thread here, so the cap has to leave
+    # threads free for ordinary requests (see gunicorn.conf.py). Under asgi.py
+    # streams are served by an async handler instead of this route.
+    if not acquire_stream_slot():
+        return Response('Too many open message streams', status=503, headers={'Retry-After': '5'})
+
+    def events():
+        nonlocal last_id
+        yield "retry: 3000\n\n"
+        while True:
+            new_messages = wait_for_messages(patient, last_id, SSE_HEARTBEAT_SECONDS)
+            if not new_messages:
+                yield ": keepalive\n\n"
+                continue
+            for message in new_messages:
+                last_id = message['id']
+                yield sse_message_event(message)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Released when the server closes the response, which also happens when it is
+    # closed before the generator ever started (a generator's finally would not run)
+    response.call_on_close(release_stream_slot)
+    return response
+
 # =====================
 # EXISTING FLASK ROUTES
 # =====================
@@ -844,19 +2607,17 @@ def billing_alerts():
 def login_page():
     return render_template('login.html')
 
-@server.route('/get-otp', methods=['POST'])
-def get_otp():
-    mobile = request.json.get('mobile')
-    
+def issue_otp(mobile):
+    # Returns the JSON payload and the OTP to deliver (None when rejected)
     if not mobile or len(mobile) != 10 or not mobile.isdigit():
-        return jsonify({'success': False, 'message': 'Please enter a valid 10-digit mobile number'})
+        return {'success': False, 'message': 'Please enter a valid 10-digit mobile number'}, None
     
     # Only allow the specific demo patient
     if mobile != '1234567890':
-        return jsonify({
+        return {
             'success': False, 
             'message': 'Your phone number is not valid as it is not registered with us. Please contact admin if you think there is a mistake'
-        })
+        }, None
     
     otp = str(random.randint(1000, 999999))
     otp_storage[mobile] = {
@@ -865,33 +2626,42 @@ def get_otp():
         'verified': False
     }
     
-    print(f"OTP for {mobile}: {otp}")  # For testing
-    
-    return jsonify({'success': True, 'message': 'OTP sent successfully', 'otp': otp})  # Return OTP for demo
+    return {'success': True, 'message': 'OTP sent successfully', 'otp': otp}, otp  # Return OTP for demo
 
-@server.route('/verify-otp', methods=['POST'])
-def verify_otp():
-    mobile = request.json.get('mobile')
-    otp_entered = request.json.get('otp')
-    remember_me = request.json.get('remember_me', False)
-    
+def check_otp(mobile, otp_entered, remember_me):
+    # Returns the JSON payload and the session values to set on success
     if mobile in otp_storage:
         stored_otp = otp_storage[mobile]
         
         if time.time() - stored_otp['timestamp'] > 300:
-            return jsonify({'success': False, 'message': 'OTP expired'})
+            return {'success': False, 'message': 'OTP expired'}, None
         
         if stored_otp['otp'] == otp_entered:
-            session['user'] = f"user_{mobile}"
-            session['role'] = 'user'
-            session['name'] = f"Patient {mobile}"
-            session['mobile'] = mobile
-            session['remember_me'] = remember_me
-            
             otp_storage[mobile]['verified'] = True
-            return jsonify({'success': True, 'message': 'Login successful'})
+            return {'success': True, 'message': 'Login successful'}, {
+                'user': f"user_{mobile}",
+                'role': 'user',
+                'name': f"Patient {mobile}",
+                'mobile': mobile,
+                'remember_me': remember_me
+            }
     
-    return jsonify({'success': False, 'message': 'Invalid OTP'})
+    return {'success': False, 'message': 'Invalid OTP'}, None
+
+@server.route('/get-otp', methods=['POST'])
+def get_otp():
+    payload, otp = issue_otp(request.json.get('mobile'))
+    if otp:
+        asyncio.run(otp_sender.send(request.json.get('mobile'), otp))
+    return jsonify(payload)
+
+@server.route('/verify-otp', methods=['POST'])
+def verify_otp():
+    payload, session_values = check_otp(request.json.get('mobile'), request.json.get('otp'),
+                                        request.json.get('remember_me', False))
+    if session_values:
+        session.update(session_values)
+    return jsonify(payload)
 
 @server.route('/admin-login', methods=['POST'])
 def admin_login():
@@ -922,7 +2692,10 @@ def appointments():
 def messages():
     if 'user' not in session:
         return redirect('/')
-    return render_template('messages.html', user=session)
+    latest = latest_messages(session['user'])
+    threads = [{**thread, 'latest': latest.get(thread['name'])} for thread in message_threads]
+    threads.sort(key=lambda t: t['latest']['timestamp'] if t['latest'] else 0, reverse=True)
+    return render_template('messages.html', user=session, threads=threads)
 
 @server.route('/records')
 def records():
@@ -945,8 +2718,12 @@ def logout():
 def admin_dashboard_auth():
     if 'user' not in session or session['role'] != 'admin':
         return redirect('/')
+    dashboard_session_id()
     return dash_app.index()
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['warm-cache']:
+        warm_dashboard_cache()
+        sys.exit(0)
     port = int(os.environ.get("PORT", 8080))
     server.run(debug=False, host='0.0.0.0', port=port)